@@ -0,0 +1,207 @@
+# Caches of generated answers for the Streamlit app (app.py).
+#
+# AnswerCache: identical questions that retrieve the same documents get the
+# stored answer instead of a new Gemini generation. Entries live in an
+# in-process LRU, and optionally in a SQLite file that survives restarts.
+#
+# SemanticAnswerCache: paraphrases of a recently answered question ("food
+# insecurity Sudan 2024", "Sudan food crisis in 2024") get its answer and
+# documents, without calling the similarity API or Gemini. Questions are
+# compared by the cosine of their embeddings, in a small in-memory matrix.
+#
+# Configured through environment variables:
+#   ANSWER_CACHE_SIZE              answers kept in memory (0 disables the cache)
+#   ANSWER_CACHE_TTL               seconds before an answer expires (0: never); both caches
+#   ANSWER_CACHE_PATH              SQLite file to persist answers to (unset: memory only)
+#   ANSWER_CACHE_ANY_TEMPERATURE   also cache answers generated at temperature > 0; both caches
+#   SEMANTIC_CACHE_SIZE            questions kept by the semantic cache (0 disables it)
+#   SEMANTIC_CACHE_THRESHOLD       smallest cosine similarity that counts as the same question
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+NUMBER = re.compile(r"\d+")
+
+
+def normalize_query(text):
+    """Case- and whitespace-folded question text, so trivially different questions share entries."""
+    return " ".join(str(text).split()).casefold()
+
+
+def any_temperature():
+    return os.getenv("ANSWER_CACHE_ANY_TEMPERATURE", "").lower() in ("1", "true", "yes")
+
+
+class AnswerCache:
+    """Answers keyed by (normalized question, prompt, model, temperature, k, retrieved uuids)."""
+
+    def __init__(self, max_size=256, ttl=86400, path=None, any_temperature=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.any_temperature = any_temperature
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            with self._connect() as connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS answers "
+                                   "(key TEXT PRIMARY KEY, answer TEXT NOT NULL, created REAL NOT NULL)")
+
+    @classmethod
+    def from_config(cls):
+        return cls(int(os.getenv("ANSWER_CACHE_SIZE", 256)), float(os.getenv("ANSWER_CACHE_TTL", 86400)) or None,
+                   os.getenv("ANSWER_CACHE_PATH") or None, any_temperature())
+
+    def _connect(self):
+        # A connection per call: Streamlit runs each session's script in its own thread
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        return sqlite3.connect(self.path, timeout=5)
+
+    def cacheable(self, temperature):
+        """Only answers generated deterministically are reused, unless ANSWER_CACHE_ANY_TEMPERATURE is set."""
+        return self.max_size > 0 and (temperature == 0 or self.any_temperature)
+
+    @staticmethod
+    def key(query, prompt, model_name, temperature, k, uuids):
+        # The prompt is part of the key so a changed system prompt doesn't serve answers written for the old one
+        payload = json.dumps([normalize_query(query), prompt, model_name, float(temperature), k,
+                              sorted(str(uuid) for uuid in uuids)])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def expired(self, created):
+        return bool(self.ttl) and time.time() - created > self.ttl
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self.expired(item[1]):
+                del self._items[key]
+                item = None
+            if item is not None:
+                self._items.move_to_end(key)
+        if item is None and self.path:
+            with self._connect() as connection:
+                row = connection.execute("SELECT answer, created FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is not None and not self.expired(row[1]):
+                item = tuple(row)
+                self._remember(key, item)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, answer):
+        if self.max_size <= 0:
+            return
+        item = (answer, time.time())
+        self._remember(key, item)
+        if self.path:
+            with self._connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?)", (key, *item))
+                # Keep the file to the same bound as memory, newest first
+                connection.execute("DELETE FROM answers WHERE key NOT IN "
+                                   "(SELECT key FROM answers ORDER BY created DESC LIMIT ?)", (self.max_size,))
+
+    def _remember(self, key, item):
+        with self._lock:
+            self._items[key] = item
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self._items), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None}
+
+
+class SemanticAnswerCache:
+    """(answer, documents) of recent questions, found by embedding similarity.
+
+    A lookup only considers entries with the same scope (model, temperature,
+    k and filters) and the same numbers in the question, since embeddings
+    barely tell "Sudan 2023" from "Sudan 2024". Among those, the most similar
+    question is a hit when its cosine similarity reaches the threshold. When
+    full, a new entry replaces the least recently used one.
+    """
+
+    def __init__(self, max_size=512, threshold=0.9, ttl=86400, any_temperature=False):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        self.any_temperature = any_temperature
+        self.hits = 0
+        self.misses = 0
+        # Unit-length question embeddings, one row per slot; allocated on the first put
+        self.vectors = None
+        self.entries = [None] * max_size
+        self.last_used = np.zeros(max_size)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        return cls(int(os.getenv("SEMANTIC_CACHE_SIZE", 512)), float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.9)),
+                   float(os.getenv("ANSWER_CACHE_TTL", 86400)) or None, any_temperature())
+
+    def cacheable(self, temperature):
+        return self.max_size > 0 and (temperature == 0 or self.any_temperature)
+
+    @staticmethod
+    def scope(model_name, temperature, k, filters=None):
+        return json.dumps([model_name, float(temperature), k, filters or {}], sort_keys=True)
+
+    @staticmethod
+    def normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def get(self, query, embedding, scope):
+        """(answer, documents, similarity) of the closest cached question, or None below the threshold."""
+        numbers = frozenset(NUMBER.findall(query))
+        with self._lock:
+            candidates = [i for i, entry in enumerate(self.entries)
+                          if entry is not None and entry["scope"] == scope and entry["numbers"] == numbers
+                          and not (self.ttl and time.time() - entry["created"] > self.ttl)]
+            if candidates:
+                similarities = self.vectors[candidates] @ self.normalize(embedding)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    slot = candidates[best]
+                    self.last_used[slot] = time.time()
+                    self.hits += 1
+                    entry = self.entries[slot]
+                    return entry["answer"], entry["documents"], float(similarities[best])
+            self.misses += 1
+            return None
+
+    def put(self, query, embedding, scope, answer, documents):
+        if self.max_size <= 0:
+            return
+        vector = self.normalize(embedding)
+        with self._lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_size, len(vector)), dtype=np.float32)
+            # An empty slot if there is one, else the least recently used entry
+            free = [i for i, entry in enumerate(self.entries) if entry is None]
+            slot = free[0] if free else int(np.argmin(self.last_used))
+            self.vectors[slot] = vector
+            self.entries[slot] = {"scope": scope, "numbers": frozenset(NUMBER.findall(query)),
+                                  "answer": answer, "documents": documents, "created": time.time()}
+            self.last_used[slot] = time.time()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": sum(entry is not None for entry in self.entries), "max_size": self.max_size,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None}
@@ -1,59 +1,96 @@
-import numpy as np
-from flask import Flask, request, jsonify
-from sentence_transformers import SentenceTransformer
-from google.cloud import bigquery
+from flask import Flask, Response, request, jsonify, stream_with_context
 
-# Initialize app and dependencies
+import service
+from responses import FastJSONProvider, compress_response
+
+# Initialize app. The model, caches and backend live in service.py; under gunicorn
+# (gunicorn.conf.py) they load once in the master process, before the workers fork,
+# unless STARTUP_MODE defers them.
 app = Flask(__name__)
-model = SentenceTransformer('all-MiniLM-L6-v2')
-client = bigquery.Client()
+# orjson serialization, and gzip/br/zstd bodies for clients that accept them (RESPONSE_COMPRESSION)
+app.json = FastJSONProvider(app)
+
+
+@app.after_request
+def compress(response):
+    return compress_response(response, request.headers.get("Accept-Encoding"))
+
+
+def ndjson(results, preview_chars):
+    # One JSON object per line as each result is ready; a failure midway becomes a final error line
+    try:
+        for result in results:
+            yield app.json.dumps(service.truncate_preview(result, preview_chars)) + "\n"
+    except Exception as e:
+        yield app.json.dumps({"error": str(e)}) + "\n"
+
 
 # API Endpoint
 @app.route('/similarity', methods=['POST'])
 def similarity_search():
     try:
         # Parse request
-        data = request.json
-        input_text = data.get("text")
-        k = int(data.get("k", 10))  # Default to 10 items if k is not provided
+        try:
+            input_text, k, fields, filters, preview_chars = service.parse_query(request.json)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        if not input_text:
-            return jsonify({"error": "Text input is required"}), 400
+        # Opt-in streaming ({"stream": true} or Accept: application/x-ndjson)
+        if service.wants_stream(request.json, request.headers.get("Accept")):
+            results = service.iter_search(input_text, k, fields, filters)
+            return Response(stream_with_context(ndjson(results, preview_chars)), mimetype="application/x-ndjson")
 
-        # Generate input embedding
-        input_embedding = model.encode(input_text).tolist()
-
-        # BigQuery ANN search
-        query = """
-        SELECT 
-            *,
-            ML.DISTANCE(embedding, @input_embedding, 'COSINE') AS similarity
-        FROM 
-            `eternal-galaxy-447417-u8.humanitarian_db.pages_metadata`
-        ORDER BY 
-            similarity ASC
-        LIMIT @k;
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ArrayQueryParameter("input_embedding", "FLOAT64", input_embedding),
-                bigquery.ScalarQueryParameter("k", "INT64", k)
-            ]
-        )
-
-        query_job = client.query(query, job_config=job_config)
-        results = [{"uuid": row["uuid"], "id": row["id"], "page_label": row["page_label"], "title": row["title"],
-                    "document": row["document"], "summary_page": row["summary_page"], "date_created": row["date_created"],
-                    "year": row["year"], "disaster": row["disaster"],"feature": row["feature"],"file": row["file"],
-                    "ocha_product": row["ocha_product"], "origin": row["origin"],"country_name": row["country_name"],
-                    "source": row["source"],"theme_name": row["theme_name"],"URL": row["URL"],"combined_details": row["combined_details"],
-                    "embedding": row["embedding"],"similarity": row["similarity"]} for row in query_job]
+        # Top-k search on the configured backend (BigQuery unless RETRIEVAL_BACKEND says otherwise)
+        results = service.truncate_previews(service.search(input_text, k, fields, filters), preview_chars)
 
+        return jsonify({"results": results}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Many queries in one call, e.g. for evaluation jobs:
+# {"queries": [{"text": ..., "k": ..., "filters": {...}}, ...], "fields": [...], "preview_chars": ...}
+@app.route('/similarity/batch', methods=['POST'])
+def similarity_batch():
+    try:
+        try:
+            texts, ks, fields, filters, preview_chars = service.parse_batch(request.json)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Results come back in the order of the queries
+        results = [service.truncate_previews(r, preview_chars)
+                   for r in service.search_batch(texts, ks, fields, filters)]
 
         return jsonify({"results": results}), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# The query embedding alone, e.g. for clients that cache answers by question similarity
+@app.route('/embed', methods=['POST'])
+def embed():
+    try:
+        input_text = (request.json or {}).get("text")
+        if not input_text:
+            return jsonify({"error": "Text input is required"}), 400
+
+        return jsonify({"embedding": service.embed(input_text).tolist()}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    body, status = service.readiness()
+    return jsonify(body), status
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(service.stats()), 200
+
+# Development server; in the container the app is served by gunicorn
 if __name__ == "__main__":
+    if service.STARTUP_MODE == "background":
+        service.start_loading()
     app.run(host="0.0.0.0", port=8080)
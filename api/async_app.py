@@ -0,0 +1,299 @@
+# asyncio version of the similarity API, for holding many in-flight queries in
+# one process: hypercorn async_app:app --bind 0.0.0.0:8080
+#
+# Request handling never blocks the event loop. Embedding runs in a bounded
+# thread pool; BigQuery jobs are submitted and polled with short calls on an I/O
+# pool, so a waiting query holds no thread; local index searches run in a pool
+# of their own. Each backend has a concurrency limit.
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from google.api_core import exceptions
+from quart import Quart, Response, request, jsonify
+from quart.wrappers.response import DataBody, IterableBody
+
+import responses
+import service
+from backends import BigQueryBackend, make_result
+
+app = Quart(__name__)
+app.json = responses.FastJSONProvider(app)
+
+# Threads encoding queries; concurrent ones still share micro-batches in the encoder
+embed_executor = ThreadPoolExecutor(int(os.getenv("ASYNC_EMBED_THREADS", 8)), thread_name_prefix="embed")
+# Threads for short blocking calls: BigQuery job submission, status polls and row fetches
+io_executor = ThreadPoolExecutor(int(os.getenv("ASYNC_IO_THREADS", 32)), thread_name_prefix="io")
+# Threads for CPU-bound local index searches
+search_executor = ThreadPoolExecutor(int(os.getenv("ASYNC_SEARCH_THREADS", os.cpu_count() or 1)),
+                                     thread_name_prefix="search")
+
+# In-flight operations allowed per backend; further requests wait their turn
+limits = {
+    "embedding": asyncio.Semaphore(int(os.getenv("ASYNC_EMBED_CONCURRENCY", 64))),
+    "bigquery": asyncio.Semaphore(int(os.getenv("ASYNC_BIGQUERY_CONCURRENCY", 200))),
+    "local": asyncio.Semaphore(int(os.getenv("ASYNC_LOCAL_CONCURRENCY", 2 * (os.cpu_count() or 1)))),
+}
+
+# Seconds between BigQuery job status polls, growing up to the maximum
+POLL_INITIAL = 0.05
+POLL_MAX = 1.0
+
+
+async def run_in(executor, function, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(function, *args, **kwargs))
+
+
+async def ensure_loaded():
+    # Waits for (or does) service.load() off the loop, so other requests and /ready keep being served
+    if not service.ready():
+        await run_in(io_executor, service.load)
+
+
+async def embed(text):
+    async with limits["embedding"]:
+        return (await run_in(embed_executor, service.embedding_cache.encode, text)).tolist()
+
+
+async def wait_for_job(query_job):
+    delay = POLL_INITIAL
+    while not await run_in(io_executor, query_job.done):
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, POLL_MAX)
+
+
+async def bigquery_search(backend, embedding, k, fields, filters, keyword_uuids=None):
+    queries, parameters = await run_in(io_executor, backend.plans, fields, filters, keyword_uuids)
+    for attempt, query in enumerate(queries):
+        query_job = await run_in(io_executor, backend.client.query, query,
+                                 job_config=backend.job_config(embedding, k, parameters))
+        try:
+            await wait_for_job(query_job)
+            rows = await run_in(io_executor, lambda: list(query_job.result()))
+        except exceptions.BadRequest as e:
+            if attempt == len(queries) - 1:
+                raise
+            backend.vector_search_failed(e)
+            continue
+        return [make_result(row, row["similarity"], fields) for row in rows]
+
+
+async def bigquery_iter_search(backend, embedding, k, fields, filters):
+    queries, parameters = await run_in(io_executor, backend.plans, fields, filters)
+    for attempt, query in enumerate(queries):
+        query_job = await run_in(io_executor, backend.client.query, query,
+                                 job_config=backend.job_config(embedding, k, parameters))
+        try:
+            await wait_for_job(query_job)
+            pages = iter((await run_in(io_executor, query_job.result, page_size=backend.stream_page_size)).pages)
+            page = await run_in(io_executor, next, pages, None)
+        except exceptions.BadRequest as e:
+            if attempt == len(queries) - 1:
+                raise
+            backend.vector_search_failed(e)
+            continue
+        # Each page is fetched off the loop and its rows sent before the next is requested
+        while page is not None:
+            for row in page:
+                yield make_result(row, row["similarity"], fields)
+            page = await run_in(io_executor, next, pages, None)
+        return
+
+
+async def backend_iter_search(embedding, k, fields, filters):
+    backend = service.backend
+    if isinstance(backend, BigQueryBackend):
+        async with limits["bigquery"]:
+            async for result in bigquery_iter_search(backend, embedding, k, fields, filters):
+                yield result
+        return
+    async with limits["local"]:
+        # Ranking happens here, on the pool; rows are then decoded one by one as they are sent
+        results = await run_in(search_executor, backend.iter_search, embedding, k, fields, filters)
+    for result in results:
+        yield result
+
+
+async def backend_search(embedding, k, fields, filters, keyword_uuids=None):
+    backend = service.backend
+    if isinstance(backend, BigQueryBackend):
+        async with limits["bigquery"]:
+            return await bigquery_search(backend, embedding, k, fields, filters, keyword_uuids)
+    async with limits["local"]:
+        return await run_in(search_executor, backend.search, embedding, k, fields, filters, keyword_uuids)
+
+
+async def retrieve(input_text, k, fields, filters):
+    """Same as service.retrieve; the keyword search runs while the query is embedded."""
+    if service.lexical is None:
+        return await backend_search(await embed(input_text), k, fields, filters)
+    candidates = max(k, service.HYBRID_CANDIDATES)
+    hits = asyncio.ensure_future(run_in(search_executor, service.lexical.top_k, input_text, candidates, filters))
+    embedding = await embed(input_text)
+    hits = await hits
+    results = await backend_search(embedding, candidates, service.with_columns(fields, "uuid"), filters,
+                                   hits[0].tolist())
+    return service.fuse(k, fields, results[:candidates], hits, results[candidates:])
+
+
+async def rank(input_text, k, fields, filters):
+    """Same as service.rank; the cross-encoder and MMR run on the search pool."""
+    candidates, pool_fields = service.pool(k, fields)
+    results = await retrieve(input_text, candidates, pool_fields, filters)
+    if service.reranker is None and not service.DIVERSIFY:
+        return results[:k], True
+    return await run_in(search_executor, service.refine, input_text, results, k, fields)
+
+
+async def search(input_text, k, fields, filters):
+    """Same as service.search, awaiting each slow step instead of blocking on it."""
+    result_cache = service.result_cache
+    if not result_cache.enabled:
+        return (await rank(input_text, k, fields, filters))[0]
+    key = result_cache.key(input_text, fields, filters)
+    version = await run_in(io_executor, service.backend.corpus_version)
+    results = result_cache.get(key, k, version)
+    if results is None:
+        fetch_k = max(k, service.RESULT_CACHE_FETCH_K)
+        results, complete = await rank(input_text, fetch_k, fields, filters)
+        service.cache_results(key, fetch_k, version, results, complete)
+    return results[:k]
+
+
+async def iter_search(input_text, k, fields, filters):
+    """Same as service.iter_search, awaiting each slow step instead of blocking on it."""
+    if service.lexical is not None or service.reranker is not None or service.DIVERSIFY:
+        for result in await search(input_text, k, fields, filters):
+            yield result
+        return
+    result_cache = service.result_cache
+    if not result_cache.enabled:
+        async for result in backend_iter_search(await embed(input_text), k, fields, filters):
+            yield result
+        return
+    key = result_cache.key(input_text, fields, filters)
+    version = await run_in(io_executor, service.backend.corpus_version)
+    results = result_cache.get(key, k, version)
+    if results is not None:
+        for result in results[:k]:
+            yield result
+        return
+    fetch_k = max(k, service.RESULT_CACHE_FETCH_K)
+    results = []
+    async for result in backend_iter_search(await embed(input_text), fetch_k, fields, filters):
+        if len(results) < k:
+            yield result
+        results.append(result)
+    result_cache.put(key, fetch_k, version, results)
+
+
+async def ndjson(results, preview_chars):
+    try:
+        async for result in results:
+            yield app.json.dumps(service.truncate_preview(result, preview_chars)) + "\n"
+    except Exception as e:
+        yield app.json.dumps({"error": str(e)}) + "\n"
+
+
+async def compress_body(body, encoding):
+    compressor = responses.StreamCompressor(encoding)
+    async with body as chunks:
+        async for chunk in chunks:
+            yield compressor.compress(chunk)
+    yield compressor.finish()
+
+
+@app.before_serving
+async def start_loading():
+    if service.STARTUP_MODE == "background":
+        service.start_loading()
+
+
+@app.after_request
+async def compress(response):
+    # Same negotiation as responses.compress_response; Quart bodies are read asynchronously
+    if not responses.compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = responses.negotiate(request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+    if isinstance(response.response, DataBody):
+        data = await response.get_data()
+        if len(data) < responses.MIN_SIZE:
+            return response
+        response.set_data(await run_in(io_executor, responses.compress, data, encoding))
+    elif isinstance(response.response, IterableBody):
+        response.response = IterableBody(compress_body(response.response, encoding))
+    else:
+        return response
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+# API Endpoint
+@app.route('/similarity', methods=['POST'])
+async def similarity_search():
+    try:
+        # Parse request
+        try:
+            data = await request.get_json()
+            input_text, k, fields, filters, preview_chars = service.parse_query(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        await ensure_loaded()
+        if service.wants_stream(data, request.headers.get("Accept")):
+            results = iter_search(input_text, k, fields, filters)
+            return Response(ndjson(results, preview_chars), mimetype="application/x-ndjson")
+
+        results = service.truncate_previews(await search(input_text, k, fields, filters), preview_chars)
+
+        return jsonify({"results": results}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/similarity/batch', methods=['POST'])
+async def similarity_batch():
+    try:
+        try:
+            texts, ks, fields, filters, preview_chars = service.parse_batch(await request.get_json())
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        await ensure_loaded()
+        # A batch is already one encode call and one search, so it runs whole on the I/O pool
+        limit = limits["bigquery" if isinstance(service.backend, BigQueryBackend) else "local"]
+        async with limit:
+            found = await run_in(io_executor, service.search_batch, texts, ks, fields, filters)
+        results = [service.truncate_previews(r, preview_chars) for r in found]
+
+        return jsonify({"results": results}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/embed', methods=['POST'])
+async def embed_text():
+    try:
+        input_text = ((await request.get_json()) or {}).get("text")
+        if not input_text:
+            return jsonify({"error": "Text input is required"}), 400
+
+        await ensure_loaded()
+        return jsonify({"embedding": await embed(input_text)}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/ready', methods=['GET'])
+async def ready():
+    body, status = service.readiness()
+    return jsonify(body), status
+
+@app.route('/stats', methods=['GET'])
+async def stats():
+    return jsonify(service.stats()), 200
@@ -0,0 +1,836 @@
+# Retrieval backends for the similarity API.
+# Each backend answers "top-k pages closest to this embedding" and returns
+# result dicts in the same shape the /similarity endpoint has always served.
+
+import json
+import os
+import time
+
+import numpy as np
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+from filters import FILTER_COLUMNS, FilterIndex, resolve_filters
+from store import EmbeddingStore
+
+TABLE = "eternal-galaxy-447417-u8.humanitarian_db.pages_metadata"
+
+# Columns of pages_metadata returned with every result (besides the score)
+COLUMNS = ["uuid", "id", "page_label", "title", "document", "summary_page", "date_created",
+           "year", "disaster", "feature", "file", "ocha_product", "origin", "country_name",
+           "source", "theme_name", "URL", "combined_details", "embedding"]
+
+
+# Returned unless a request asks for other fields: what the Streamlit app shows and
+# prompts with, plus the page and report ids. Raw embeddings are opt-in.
+DEFAULT_FIELDS = ["uuid", "id", "title", "source", "page_label", "URL", "combined_details", "document"]
+
+
+def resolve_fields(fields=None):
+    """Validate a requested field list; None gives DEFAULT_FIELDS and "*" every column."""
+    if fields is None:
+        return list(DEFAULT_FIELDS)
+    if fields == "*" or fields == ["*"]:
+        return list(COLUMNS)
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown fields {unknown}, expected any of {COLUMNS}")
+    return list(dict.fromkeys(fields))
+
+
+def make_result(row, similarity, fields, embedding=None):
+    """Build the response dict for one page; `similarity` is the cosine distance."""
+    result = {column: row[column] for column in fields if column != "embedding"}
+    if "embedding" in fields:
+        result["embedding"] = row["embedding"] if embedding is None else embedding
+    result["similarity"] = similarity
+    return result
+
+
+def normalize(vectors):
+    """L2-normalize rows (or a single vector) as contiguous float32."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+# ----------------------------
+# BigQuery: cosine distance computed in the warehouse
+# ----------------------------
+DATASET = TABLE.rsplit(".", 1)[0]
+VECTOR_INDEX = "pages_embedding_index"
+# Columns kept in the vector index next to the embeddings. A filtered VECTOR_SEARCH
+# whose base query reads only these (and `embedding`) is pre-filtered in the index;
+# any other column makes BigQuery scan the table and filter afterwards.
+STORED_COLUMNS = [*DEFAULT_FIELDS, *(column for column in FILTER_COLUMNS if column not in DEFAULT_FIELDS)]
+
+# Exact: distance to every row, then sort (full scan, works without an index)
+DISTANCE_QUERY = """
+SELECT
+    {columns},
+    ML.DISTANCE(embedding, @input_embedding, 'COSINE') AS similarity
+FROM
+    `{table}`
+{where}
+ORDER BY
+    similarity ASC
+LIMIT @k;
+"""
+
+# Exact, for hybrid search: the k nearest rows plus the keyword index's hits, with their
+# distances. Only (uuid, distance) is ranked, so BigQuery runs a distributed top-k
+# rather than sorting every projected column; the keyword hits already match the filters.
+HYBRID_DISTANCE_QUERY = """
+SELECT
+    {columns},
+    ML.DISTANCE(embedding, @input_embedding, 'COSINE') AS similarity
+FROM
+    `{table}`
+WHERE
+    uuid IN (
+        SELECT uuid
+        FROM `{table}`
+        {where}
+        ORDER BY ML.DISTANCE(embedding, @input_embedding, 'COSINE') ASC
+        LIMIT @k
+    )
+    OR uuid IN UNNEST(@keyword_uuids)
+ORDER BY
+    similarity ASC;
+"""
+
+# Approximate: only the lists of the vector index closest to the query are scanned.
+# With filters, the base table is a filtered subquery so they apply before ranking.
+VECTOR_SEARCH_QUERY = """
+SELECT
+    {columns},
+    distance AS similarity
+FROM
+    VECTOR_SEARCH(
+        {base}, 'embedding',
+        (SELECT @input_embedding AS embedding),
+        top_k => @k, distance_type => 'COSINE'{options})
+ORDER BY
+    similarity ASC;
+"""
+
+# Several queries in one job: the table is scanned once for all of them, and the
+# per-query filters and k travel inside the @queries array of structs. The top k of
+# each query is kept as (uuid, distance) only; the requested columns are joined back
+# for those rows alone. ARRAY_AGG needs a literal LIMIT, the largest k.
+BATCH_DISTANCE_QUERY = """
+WITH nearest AS (
+    SELECT
+        query_index,
+        hit.uuid,
+        hit.similarity
+    FROM (
+        SELECT
+            query_index,
+            ANY_VALUE(k) AS k,
+            ARRAY_AGG(STRUCT(uuid, similarity) ORDER BY similarity ASC LIMIT {max_k}) AS hits
+        FROM (
+            SELECT
+                q.query_index,
+                q.k,
+                t.uuid,
+                ML.DISTANCE(t.embedding, q.embedding, 'COSINE') AS similarity
+            FROM
+                `{table}` AS t
+            CROSS JOIN
+                UNNEST(@queries) AS q
+            WHERE {where}
+        )
+        GROUP BY query_index
+    ),
+    UNNEST(hits) AS hit WITH OFFSET AS position
+    WHERE position < k
+)
+SELECT
+    n.query_index,
+    {columns},
+    n.similarity
+FROM
+    nearest AS n
+JOIN
+    `{table}` AS t
+ON
+    t.uuid = n.uuid
+ORDER BY
+    query_index, similarity ASC;
+"""
+
+# VECTOR_SEARCH takes a table of queries natively, but shares top_k and the base table
+BATCH_VECTOR_SEARCH_QUERY = """
+SELECT
+    query.query_index,
+    {columns},
+    distance AS similarity
+FROM
+    VECTOR_SEARCH(
+        {base}, 'embedding',
+        (SELECT query_index, embedding FROM UNNEST(@queries)),
+        top_k => @k, distance_type => 'COSINE'{options})
+ORDER BY
+    query_index, similarity ASC;
+"""
+
+
+class BigQueryBackend:
+    name = "bigquery"
+
+    # Seconds before the vector index status, or the table's modification time, is looked up again
+    index_check_interval = 600
+    version_check_interval = 60
+
+    def __init__(self, client, mode="distance", fraction_lists_to_search=None):
+        if mode not in ("distance", "vector_search"):
+            raise ValueError(f"Unknown BigQuery query mode '{mode}', expected 'distance' or 'vector_search'")
+        self.client = client
+        self.mode = mode
+        self.fraction_lists_to_search = fraction_lists_to_search
+        self._index_checked_at = None
+        self._index_ready = False
+        self._version_checked_at = None
+        self._version = None
+
+    @classmethod
+    def from_config(cls, client):
+        fraction = os.getenv("BQ_FRACTION_LISTS_TO_SEARCH")
+        return cls(client, mode=os.getenv("BQ_QUERY_MODE", "distance").lower(),
+                   fraction_lists_to_search=float(fraction) if fraction else None)
+
+    def corpus_version(self):
+        """Last modification time of pages_metadata, so caches notice new ingestion."""
+        now = time.monotonic()
+        if self._version_checked_at is None or now - self._version_checked_at > self.version_check_interval:
+            self._version_checked_at = now
+            self._version = self.client.get_table(TABLE).modified.isoformat()
+        return self._version
+
+    def index_ready(self):
+        """Whether the vector index on pages_metadata.embedding exists and is active."""
+        now = time.monotonic()
+        if self._index_checked_at is None or now - self._index_checked_at > self.index_check_interval:
+            self._index_checked_at = now
+            self._index_ready = any(row["index_status"] == "ACTIVE" for row in vector_index_status(self.client))
+            if not self._index_ready:
+                print(f"Vector index {VECTOR_INDEX} is missing or not active; using ML.DISTANCE")
+        return self._index_ready
+
+    def vector_search_sql(self, fields, where="", template=VECTOR_SEARCH_QUERY):
+        options = ""
+        if self.fraction_lists_to_search is not None:
+            options = ", options => '" + json.dumps({"fraction_lists_to_search": self.fraction_lists_to_search}) + "'"
+        columns = ", ".join(f"base.{field}" for field in fields)
+        # Only the columns needed, so that with the default fields the base query reads stored columns only
+        base_columns = ", ".join(dict.fromkeys([*fields, *FILTER_COLUMNS, "embedding"]))
+        base = f"(SELECT {base_columns} FROM `{TABLE}` WHERE {where})" if where else f"TABLE `{TABLE}`"
+        return template.format(base=base, columns=columns, options=options)
+
+    def distance_sql(self, fields, where="", template=DISTANCE_QUERY):
+        # Only the requested columns are read, and billed
+        return template.format(table=TABLE, columns=", ".join(fields), where=f"WHERE {where}" if where else "")
+
+    def plans(self, fields, filters, keyword_uuids=None):
+        """SQL to try in order for one query, and the parameters they share.
+
+        VECTOR_SEARCH comes first when enabled and the index is active; ML.DISTANCE
+        is always last, as the fallback. With `keyword_uuids`, the ML.DISTANCE query
+        also returns those pages, after the k nearest; VECTOR_SEARCH cannot add
+        them without scanning the table, so there they are left out.
+        """
+        where, parameters = filter_sql(filters)
+        queries = []
+        if self.mode == "vector_search" and self.index_ready():
+            queries.append(self.vector_search_sql(fields, where))
+        if keyword_uuids is None:
+            queries.append(self.distance_sql(fields, where))
+        else:
+            queries.append(self.distance_sql(fields, where, HYBRID_DISTANCE_QUERY))
+            parameters = [*parameters, bigquery.ArrayQueryParameter(
+                "keyword_uuids", "STRING", [str(uuid) for uuid in keyword_uuids])]
+        return queries, parameters
+
+    def job_config(self, embedding, k, parameters=()):
+        return bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter("input_embedding", "FLOAT64", list(map(float, embedding))),
+                bigquery.ScalarQueryParameter("k", "INT64", k),
+                *parameters
+            ]
+        )
+
+    def vector_search_failed(self, error):
+        # Typically the index was dropped since the last check; fall back until re-checked
+        print(f"VECTOR_SEARCH failed, falling back to ML.DISTANCE: {error}")
+        self._index_ready = False
+
+    # Rows per result page when streaming, so the first results arrive before the last
+    stream_page_size = int(os.getenv("STREAM_PAGE_SIZE", 5))
+
+    def search(self, embedding, k, fields=None, filters=None, keyword_uuids=None):
+        """The k nearest pages, nearest first, then any `keyword_uuids` pages among the rest (see plans)."""
+        fields = resolve_fields(fields)
+        queries, parameters = self.plans(fields, resolve_filters(filters), keyword_uuids)
+        for attempt, query in enumerate(queries):
+            query_job = self.client.query(query, job_config=self.job_config(embedding, k, parameters))
+            try:
+                return [make_result(row, row["similarity"], fields) for row in query_job]
+            except exceptions.BadRequest as e:
+                if attempt == len(queries) - 1:
+                    raise
+                self.vector_search_failed(e)
+
+    def iter_search(self, embedding, k, fields=None, filters=None):
+        """Like search, but yields each result as soon as its page of rows is fetched."""
+        fields = resolve_fields(fields)
+        queries, parameters = self.plans(fields, resolve_filters(filters))
+        for attempt, query in enumerate(queries):
+            query_job = self.client.query(query, job_config=self.job_config(embedding, k, parameters))
+            try:
+                rows = iter(query_job.result(page_size=self.stream_page_size))
+                first = next(rows, None)
+            except exceptions.BadRequest as e:
+                if attempt == len(queries) - 1:
+                    raise
+                self.vector_search_failed(e)
+                continue
+            if first is not None:
+                yield make_result(first, first["similarity"], fields)
+                for row in rows:
+                    yield make_result(row, row["similarity"], fields)
+            return
+
+    def search_batch(self, embeddings, ks, fields=None, filters=None):
+        """One result list per query, from a single BigQuery job; `ks` and `filters` are per query."""
+        fields = resolve_fields(fields)
+        filters = [resolve_filters(f) for f in (filters or [None] * len(ks))]
+        if not ks:
+            return []
+        # VECTOR_SEARCH needs one shared base table, so only when every query has the same filters
+        if self.mode == "vector_search" and all(f == filters[0] for f in filters) and self.index_ready():
+            where, parameters = filter_sql(filters[0])
+            queries = bigquery.ArrayQueryParameter("queries", "STRUCT", [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("query_index", "INT64", i),
+                    bigquery.ArrayQueryParameter("embedding", "FLOAT64", list(map(float, embedding))))
+                for i, embedding in enumerate(embeddings)])
+            parameters = [queries, bigquery.ScalarQueryParameter("k", "INT64", max(ks)), *parameters]
+            try:
+                return self.run_batch(self.vector_search_sql(fields, where, BATCH_VECTOR_SEARCH_QUERY),
+                                      parameters, ks, fields)
+            except exceptions.BadRequest as e:
+                self.vector_search_failed(e)
+
+        filtered = [column for column in FILTER_COLUMNS if any(column in f for f in filters)]
+        # A query with no values for a column does not filter on it
+        where = " AND ".join(
+            f"(ARRAY_LENGTH(q.filter_{column}) = 0 "
+            f"OR LOWER(TRIM(CAST(t.{column} AS STRING))) IN UNNEST(q.filter_{column}))"
+            for column in filtered) or "TRUE"
+        queries = bigquery.ArrayQueryParameter("queries", "STRUCT", [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter("query_index", "INT64", i),
+                bigquery.ArrayQueryParameter("embedding", "FLOAT64", list(map(float, embedding))),
+                bigquery.ScalarQueryParameter("k", "INT64", k),
+                *[bigquery.ArrayQueryParameter(f"filter_{column}", "STRING", f.get(column, []))
+                  for column in filtered])
+            for i, (embedding, k, f) in enumerate(zip(embeddings, ks, filters))])
+        query = BATCH_DISTANCE_QUERY.format(table=TABLE, where=where, max_k=int(max(ks)),
+                                            columns=", ".join(f"t.{field} AS {field}" for field in fields))
+        return self.run_batch(query, [queries], ks, fields)
+
+    def run_batch(self, query, parameters, ks, fields):
+        job_config = bigquery.QueryJobConfig(query_parameters=parameters)
+        output = [[] for _ in ks]
+        for row in self.client.query(query, job_config=job_config):
+            results = output[row["query_index"]]
+            if len(results) < ks[row["query_index"]]:
+                results.append(make_result(row, row["similarity"], fields))
+        return output
+
+
+def filter_sql(filters):
+    """WHERE condition and query parameters matching resolved filters (see filters.py)."""
+    conditions, parameters = [], []
+    for column, values in filters.items():
+        conditions.append(f"LOWER(TRIM(CAST({column} AS STRING))) IN UNNEST(@filter_{column})")
+        parameters.append(bigquery.ArrayQueryParameter(f"filter_{column}", "STRING", values))
+    return " AND ".join(conditions), parameters
+
+
+def vector_index_status(client):
+    """Rows of INFORMATION_SCHEMA.VECTOR_INDEXES for pages_metadata."""
+    query = f"""
+    SELECT index_name, index_status, coverage_percentage, last_refresh_time, disable_reason
+    FROM `{DATASET}`.INFORMATION_SCHEMA.VECTOR_INDEXES
+    WHERE table_name = @table AND index_name = @index;
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("table", "STRING", TABLE.rsplit(".", 1)[1]),
+            bigquery.ScalarQueryParameter("index", "STRING", VECTOR_INDEX)
+        ]
+    )
+    return list(client.query(query, job_config=job_config).result())
+
+
+def create_vector_index(client, index_type="IVF", num_lists=None, leaf_node_embedding_count=None):
+    """Create, or replace to rebuild, the vector index on pages_metadata.embedding."""
+    if index_type == "IVF":
+        options = {"num_lists": num_lists} if num_lists else {}
+        type_options = f", ivf_options = '{json.dumps(options)}'" if options else ""
+    elif index_type == "TREE_AH":
+        options = {"leaf_node_embedding_count": leaf_node_embedding_count} if leaf_node_embedding_count else {}
+        type_options = f", tree_ah_options = '{json.dumps(options)}'" if options else ""
+    else:
+        raise ValueError(f"Unknown vector index type '{index_type}', expected IVF or TREE_AH")
+    query = f"""
+    CREATE OR REPLACE VECTOR INDEX `{VECTOR_INDEX}`
+    ON `{TABLE}`(embedding)
+    STORING({", ".join(STORED_COLUMNS)})
+    OPTIONS(index_type = '{index_type}', distance_type = 'COSINE'{type_options});
+    """
+    client.query(query).result()
+
+
+def load_corpus(client):
+    """Read every page of pages_metadata once, ordered by uuid.
+
+    Returns (normalized embeddings, records); the vectors are kept out of the
+    records so they live only in the matrix, not a second time as Python lists.
+    """
+    rows = client.query(f"SELECT {', '.join(COLUMNS)} FROM `{TABLE}` ORDER BY uuid").result()
+    records, embeddings = [], []
+    for row in rows:
+        record = dict(row.items())
+        embeddings.append(record.pop("embedding"))
+        records.append(record)
+    return normalize(np.array(embeddings, dtype=np.float32).reshape(len(records), -1)), records
+
+
+def load_records(client):
+    """Read the metadata of every page, without embeddings, ordered by uuid."""
+    columns = [column for column in COLUMNS if column != "embedding"]
+    rows = client.query(f"SELECT {', '.join(columns)} FROM `{TABLE}` ORDER BY uuid").result()
+    return [dict(row.items()) for row in rows]
+
+
+def open_store():
+    """The memory-mapped EmbeddingStore at EMBEDDING_STORE, or None to read from BigQuery."""
+    path = os.getenv("EMBEDDING_STORE")
+    return EmbeddingStore(path) if path else None
+
+
+def load_source(client):
+    """(normalized embeddings, records) from the embedding store if configured, else BigQuery."""
+    store = open_store()
+    if store is not None:
+        return store.vectors, store.records
+    return load_corpus(client)
+
+
+def row_uuids(records):
+    # A store keeps its uuids in a separate array, saving a decode of every row
+    uuids = getattr(records, "uuids", None)
+    return uuids if uuids is not None else np.array([r["uuid"] for r in records])
+
+
+def save_row_order(path, records):
+    """Store the uuid order of an index's rows next to it."""
+    np.save(path + ".uuids.npy", np.asarray(row_uuids(records)))
+
+
+def check_row_order(path, records):
+    """Raise ValueError if the index at `path` was built for other rows than `records`."""
+    saved = np.load(path + ".uuids.npy")
+    if not np.array_equal(saved, row_uuids(records)):
+        raise ValueError(f"Index at {path} is stale: its rows no longer match pages_metadata")
+
+
+def select_top(scores, k):
+    """Positions of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    # argpartition finds the top-k in O(n); only those k are sorted
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def id_selector(mask):
+    """A faiss selector restricting a search to the rows set in `mask`.
+
+    Returns (selector, bitmap); the bitmap must stay referenced while searching.
+    """
+    import faiss
+    bitmap = np.packbits(mask, bitorder="little")
+    return faiss.IDSelectorBitmap(bitmap), bitmap
+
+
+class LocalBackend:
+    """Shared filtering and result handling for indexes searched inside the API process."""
+
+    # Filters matching at most this many rows are answered by exact scoring of just those rows
+    exact_filter_rows = 20000
+
+    def __init__(self, records):
+        self.records = records
+        # Fixed for the life of the process: the store's export time, or when BigQuery was read
+        self.version = getattr(records, "version", None) or time.strftime("%Y-%m-%dT%H:%M:%S")
+        # Posting lists per filter value; a store ships them, otherwise they are built once here
+        self.filter_index = getattr(records, "filter_index", None)
+        if self.filter_index is None:
+            self.filter_index = FilterIndex.build(records)
+        # uuid of every row, and (once) the same sorted with their rows, for fetch(); stores are sorted already
+        self.uuids = np.asarray(row_uuids(records))
+        self.uuid_order = None if np.all(self.uuids[:-1] <= self.uuids[1:]) else np.argsort(self.uuids, kind="stable")
+        self.sorted_uuids = self.uuids if self.uuid_order is None else self.uuids[self.uuid_order]
+
+    def corpus_version(self):
+        return self.version
+
+    def vectors_of(self, rows):
+        """Normalized float32 vectors of the given row ids."""
+        raise NotImplementedError
+
+    def vector(self, i):
+        return self.vectors_of(np.array([i], dtype=np.int64))[0]
+
+    def top_k(self, query, k, mask=None):
+        """Return (row ids, cosine similarities) of the k best rows allowed by `mask`, best first."""
+        raise NotImplementedError
+
+    def top_k_rows(self, query, k, rows):
+        """Exact top-k among the given candidate rows."""
+        scores = self.vectors_of(rows) @ query
+        top = select_top(scores, k)
+        return rows[top], scores[top]
+
+    def top_k_batch(self, queries, k):
+        """top_k of several unfiltered queries; backends override this to share one pass."""
+        return [self.top_k(query, k) for query in queries]
+
+    def rank(self, query, k, mask=None):
+        if mask is None:
+            return self.top_k(query, k)
+        if np.count_nonzero(mask) <= self.exact_filter_rows:
+            return self.top_k_rows(query, k, np.flatnonzero(mask))
+        return self.top_k(query, k, mask)
+
+    def iter_results(self, ids, scores, fields):
+        # Rows are decoded one at a time, so a stream can send each before decoding the next
+        for i, s in zip(ids, scores):
+            yield make_result(self.records[i], float(1.0 - s), fields,
+                              self.vector(i).tolist() if "embedding" in fields else None)
+
+    def results(self, ids, scores, fields):
+        return list(self.iter_results(ids, scores, fields))
+
+    def iter_search(self, embedding, k, fields=None, filters=None):
+        fields = resolve_fields(fields)
+        mask = self.filter_index.mask(resolve_filters(filters))
+        return self.iter_results(*self.rank(normalize(embedding), k, mask), fields)
+
+    def search(self, embedding, k, fields=None, filters=None, keyword_uuids=None):
+        """The k best pages, then any `keyword_uuids` pages not among them."""
+        fields = resolve_fields(fields)
+        mask = self.filter_index.mask(resolve_filters(filters))
+        ids, scores = self.rank(normalize(embedding), k, mask)
+        results = self.results(ids, scores, fields)
+        if keyword_uuids is not None:
+            results += self.fetch(embedding, np.setdiff1d(np.asarray(keyword_uuids), self.uuids[ids]), fields)
+        return results
+
+    def fetch(self, embedding, uuids, fields=None):
+        """Results for the given pages, e.g. keyword hits the vector search missed; unknown uuids are skipped."""
+        fields = resolve_fields(fields)
+        uuids = np.asarray(uuids)
+        if not len(uuids) or not len(self.uuids):
+            return []
+        positions = np.minimum(np.searchsorted(self.sorted_uuids, uuids), len(self.sorted_uuids) - 1)
+        positions = positions[self.sorted_uuids[positions] == uuids]
+        rows = positions if self.uuid_order is None else self.uuid_order[positions]
+        return self.results(rows, self.vectors_of(rows) @ normalize(embedding), fields)
+
+    def search_batch(self, embeddings, ks, fields=None, filters=None):
+        """One result list per query; `ks` and `filters` are per query."""
+        fields = resolve_fields(fields)
+        queries = normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(ks), -1))
+        masks = [self.filter_index.mask(resolve_filters(f)) for f in (filters or [None] * len(ks))]
+        output = [None] * len(ks)
+        # Unfiltered queries are ranked together; filtered ones each have their own candidate rows
+        unfiltered = [i for i, mask in enumerate(masks) if mask is None]
+        if unfiltered:
+            ranked = self.top_k_batch(queries[unfiltered], max(ks[i] for i in unfiltered))
+            for i, (ids, scores) in zip(unfiltered, ranked):
+                output[i] = self.results(ids[:ks[i]], scores[:ks[i]], fields)
+        for i, mask in enumerate(masks):
+            if mask is not None:
+                output[i] = self.results(*self.rank(queries[i], ks[i], mask), fields)
+        return output
+
+
+# ----------------------------
+# NumPy: the whole corpus held in memory, exact search with one mat-vec
+# ----------------------------
+class NumpyBackend(LocalBackend):
+    name = "numpy"
+
+    # Rows scored per block when the matrix is float16, bounding the float32 temporary
+    block_rows = 65536
+
+    def __init__(self, embeddings, records):
+        if len(embeddings) != len(records):
+            raise ValueError("embeddings and records must be row-aligned")
+        super().__init__(records)
+        # Normalized once so a dot product is the cosine similarity. A memory-mapped
+        # store is normalized on export and used in place, shared by all workers.
+        self.embeddings = embeddings if isinstance(embeddings, np.memmap) else normalize(embeddings)
+
+    @classmethod
+    def from_config(cls, client):
+        return cls(*load_source(client))
+
+    def vectors_of(self, rows):
+        return np.asarray(self.embeddings[rows], dtype=np.float32)
+
+    def scores(self, queries):
+        """Cosine similarity of every row to one query, or (rows x queries) for a query matrix."""
+        queries = queries.T
+        if self.embeddings.dtype == np.float32:
+            return self.embeddings @ queries
+        return np.concatenate([np.asarray(self.embeddings[start:start + self.block_rows], dtype=np.float32) @ queries
+                               for start in range(0, len(self.embeddings), self.block_rows)] or [np.empty(0)])
+
+    def top_k(self, query, k, mask=None):
+        if mask is not None:
+            return self.top_k_rows(query, k, np.flatnonzero(mask))
+        scores = self.scores(query)
+        top = select_top(scores, k)
+        return top, scores[top]
+
+    # Queries scored per matrix product, bounding the (rows x queries) score matrix
+    query_block = 32
+
+    def top_k_batch(self, queries, k):
+        ranked = []
+        for start in range(0, len(queries), self.query_block):
+            scores = self.scores(queries[start:start + self.query_block])
+            for column in scores.T:
+                top = select_top(column, k)
+                ranked.append((top, column[top]))
+        return ranked
+
+
+# ----------------------------
+# HNSW: approximate graph search, sub-linear in the number of pages
+# ----------------------------
+class HNSWBackend(LocalBackend):
+    name = "hnsw"
+
+    def __init__(self, index, records, ef_search=64):
+        if index.ntotal != len(records):
+            raise ValueError("index and records must be row-aligned")
+        super().__init__(records)
+        self.index = index
+        self.index.hnsw.efSearch = ef_search
+
+    @classmethod
+    def build(cls, embeddings, records, m=32, ef_construction=200, ef_search=64):
+        import faiss
+        index = faiss.IndexHNSWFlat(embeddings.shape[1], m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        index.add(normalize(embeddings))
+        return cls(index, records, ef_search)
+
+    def save(self, path):
+        import faiss
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        faiss.write_index(self.index, path)
+        save_row_order(path, self.records)
+
+    @classmethod
+    def load(cls, path, records, ef_search=64):
+        import faiss
+        check_row_order(path, records)
+        # Memory-mapped, so the graph's float32 vectors stay in the page cache shared by all workers.
+        # IO_FLAG_MMAP only maps IVF inverted lists; an HNSW index needs MMAP_IFC.
+        return cls(faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY), records, ef_search)
+
+    @classmethod
+    def from_config(cls, client):
+        """Load the saved graph at HNSW_INDEX_PATH, or build and save it if absent/stale."""
+        path = os.getenv("HNSW_INDEX_PATH", "indexes/hnsw.faiss")
+        ef_search = int(os.getenv("HNSW_EF_SEARCH", 64))
+        embeddings, records = load_source(client)
+        if os.path.exists(path):
+            try:
+                return cls.load(path, records, ef_search)
+            except ValueError as e:
+                print(f"{e}; rebuilding")
+        backend = cls.build(embeddings, records, m=int(os.getenv("HNSW_M", 32)),
+                            ef_construction=int(os.getenv("HNSW_EF_CONSTRUCTION", 200)),
+                            ef_search=ef_search)
+        backend.save(path)
+        return backend
+
+    def vectors_of(self, rows):
+        return self.index.reconstruct_batch(rows)
+
+    def top_k(self, query, k, mask=None):
+        import faiss
+        k = min(k, self.index.ntotal)
+        params, bitmap = None, None
+        if mask is not None:
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = max(self.index.hnsw.efSearch, k)
+            params.sel, bitmap = id_selector(mask)
+        scores, ids = self.index.search(query.reshape(1, -1), k, params=params)
+        found = ids[0] >= 0
+        return ids[0][found], scores[0][found]
+
+    def top_k_batch(self, queries, k):
+        scores, ids = self.index.search(queries, min(k, self.index.ntotal))
+        return [(row_ids[row_ids >= 0], row_scores[row_ids >= 0]) for row_ids, row_scores in zip(ids, scores)]
+
+
+# ----------------------------
+# IVF-PQ: compressed codes in memory, optional exact re-rank from disk
+# ----------------------------
+class IVFPQBackend(LocalBackend):
+    name = "ivfpq"
+
+    def __init__(self, index, records, nprobe=16, vectors=None, rerank=0):
+        if index.ntotal != len(records):
+            raise ValueError("index and records must be row-aligned")
+        super().__init__(records)
+        self.index = index
+        self.index.nprobe = nprobe
+        # Full normalized vectors, memory-mapped so only re-ranked rows are paged in
+        self.vectors = vectors
+        self.rerank = rerank if vectors is not None else 0
+
+    @classmethod
+    def train(cls, embeddings, records, nlist=None, code_size=48, nbits=8, nprobe=16, train_size=100_000):
+        """Train coarse centroids and PQ codebooks on a sample, then encode every page."""
+        import faiss
+        embeddings = normalize(embeddings)
+        dim = embeddings.shape[1]
+        if dim % code_size:
+            raise ValueError(f"code size {code_size} must divide the embedding dimension {dim}")
+        # Rule of thumb: ~4*sqrt(n) lists, with enough training points per centroid
+        nlist = nlist or max(1, int(4 * np.sqrt(len(embeddings))))
+        nlist = min(nlist, max(1, len(embeddings) // 39))
+        index = faiss.IndexIVFPQ(faiss.IndexFlatIP(dim), dim, nlist, code_size, nbits,
+                                 faiss.METRIC_INNER_PRODUCT)
+        rng = np.random.default_rng(0)
+        sample = embeddings[rng.choice(len(embeddings), size=min(train_size, len(embeddings)), replace=False)]
+        index.train(sample)
+        index.add(embeddings)
+        return cls(index, records, nprobe)
+
+    def save(self, path, embeddings=None):
+        """Write the index; with `embeddings`, also the full vectors used for re-ranking."""
+        import faiss
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        faiss.write_index(self.index, path)
+        save_row_order(path, self.records)
+        if embeddings is not None:
+            np.save(path + ".vectors.npy", normalize(embeddings))
+
+    @classmethod
+    def load(cls, path, records, nprobe=16, rerank=0, vectors=None):
+        """Load a saved index; re-ranking reads `vectors`, or the .vectors.npy saved with it."""
+        import faiss
+        check_row_order(path, records)
+        vectors_path = path + ".vectors.npy"
+        if vectors is None and rerank and os.path.exists(vectors_path):
+            vectors = np.load(vectors_path, mmap_mode="r")
+        return cls(faiss.read_index(path), records, nprobe, vectors, rerank)
+
+    @classmethod
+    def from_config(cls, client):
+        """Load the index trained offline by `build_index.py ivfpq`."""
+        path = os.getenv("IVFPQ_INDEX_PATH", "indexes/ivfpq.faiss")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No IVF-PQ index at {path}; train one with `python build_index.py ivfpq`")
+        # The metadata and the re-rank vectors stay on disk in the store; page text held in every
+        # worker's heap instead would outweigh the float32 matrix the compressed codes replace
+        store = open_store()
+        if store is None:
+            raise ValueError("The ivfpq backend needs an embedding store; set EMBEDDING_STORE "
+                             "(export one with `python build_index.py store`)")
+        return cls.load(path, store.records, nprobe=int(os.getenv("IVFPQ_NPROBE", 16)),
+                        rerank=int(os.getenv("IVFPQ_RERANK", 0)), vectors=store.vectors)
+
+    def vectors_of(self, rows):
+        if self.vectors is not None:
+            return np.asarray(self.vectors[rows], dtype=np.float32)
+        if not self.index.direct_map.type:
+            self.index.make_direct_map()
+        # Decoded from the PQ codes, so only an approximation of the stored embeddings
+        return self.index.reconstruct_batch(rows)
+
+    def top_k(self, query, k, mask=None):
+        import faiss
+        k = min(k, self.index.ntotal)
+        pool = k * self.rerank if self.rerank else k
+        params, bitmap = None, None
+        if mask is not None:
+            params = faiss.SearchParametersIVF()
+            params.nprobe = self.index.nprobe
+            params.sel, bitmap = id_selector(mask)
+        scores, ids = self.index.search(query.reshape(1, -1), pool, params=params)
+        return self.finish(query, ids[0], scores[0], k)
+
+    def top_k_batch(self, queries, k):
+        k = min(k, self.index.ntotal)
+        scores, ids = self.index.search(queries, k * self.rerank if self.rerank else k)
+        return [self.finish(query, row_ids, row_scores, k) for query, row_ids, row_scores in zip(queries, ids, scores)]
+
+    def finish(self, query, ids, scores, k):
+        """Drop empty slots and, if enabled, re-rank the candidate pool exactly."""
+        found = ids >= 0
+        ids, scores = ids[found], scores[found]
+        if self.rerank and len(ids):
+            # Exact cosine over the candidate pool; sorted row order keeps the disk reads sequential
+            ids = np.sort(ids)
+            scores = np.asarray(self.vectors[ids], dtype=np.float32) @ query
+            best = np.argsort(-scores)[:k]
+            ids, scores = ids[best], scores[best]
+        return ids[:k], scores[:k]
+
+
+def recall_at_k(approximate, exact, queries, k=10):
+    """Mean fraction of the exact top-k that an approximate backend also returns."""
+    hits = 0
+    for query in normalize(queries):
+        truth = set(exact.top_k(query, k)[0].tolist())
+        hits += len(truth & set(approximate.top_k(query, k)[0].tolist()))
+    return hits / (len(queries) * k)
+
+
+BACKENDS = {
+    "bigquery": BigQueryBackend.from_config,
+    "numpy": NumpyBackend.from_config,
+    "hnsw": HNSWBackend.from_config,
+    "ivfpq": IVFPQBackend.from_config,
+}
+
+
+def load_backend(client, name=None):
+    """Create the backend named by RETRIEVAL_BACKEND (default: bigquery)."""
+    name = (name or os.getenv("RETRIEVAL_BACKEND", "bigquery")).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown retrieval backend '{name}', expected one of {sorted(BACKENDS)}")
+    started = time.perf_counter()
+    backend = BACKENDS[name](client)
+    print(f"Loaded '{name}' retrieval backend in {time.perf_counter() - started:.2f}s")
+    return backend
@@ -0,0 +1,229 @@
+# Offline index and model maintenance for the similarity API.
+# Usage:
+#   python build_index.py hnsw --m 32 --ef-construction 200 --ef-search 64
+#   python build_index.py ivfpq --nlist 1024 --code-size 48 --nprobe 16
+#   python build_index.py store --output store --dtype float16
+#   python build_index.py bq-index --type IVF --num-lists 1000
+#   python build_index.py bm25 --output indexes/bm25
+#   python build_index.py model --backend onnx-int8 --output models/all-MiniLM-L6-v2
+#   python build_index.py reranker --model cross-encoder/ms-marco-MiniLM-L-6-v2 --output models/reranker
+# Indexes are built from the embedding store when EMBEDDING_STORE is set.
+
+import argparse
+import os
+import time
+
+import numpy as np
+from google.cloud import bigquery
+
+from backends import (HNSWBackend, IVFPQBackend, NumpyBackend, VECTOR_INDEX, create_vector_index, load_corpus,
+                      load_records, load_source, open_store, recall_at_k, vector_index_status)
+from encoder import MIN_COSINE, MODEL_BACKENDS, MODEL_NAME, load_model, onnx_int8_file
+from lexical import BM25Index
+from store import EmbeddingStore
+
+
+def report_recall(backend, embeddings, records, k, samples):
+    """Print recall@k of `backend` against exact search, using corpus pages as queries."""
+    exact = NumpyBackend(embeddings, records)
+    rng = np.random.default_rng(0)
+    queries = embeddings[rng.choice(len(embeddings), size=min(samples, len(embeddings)), replace=False)]
+    started = time.perf_counter()
+    recall = recall_at_k(backend, exact, queries, k)
+    print(f"recall@{k} vs exact search: {recall:.4f} "
+          f"({len(queries)} queries, {time.perf_counter() - started:.2f}s)")
+
+
+def export_store(args):
+    embeddings, records = load_corpus(bigquery.Client())
+    started = time.perf_counter()
+    store = EmbeddingStore.write(args.output, embeddings, records, dtype=args.dtype)
+    print(f"Exported {len(records)} pages to {args.output} ({args.dtype}, "
+          f"{store.vectors.nbytes / 2**20:.1f} MiB of vectors) in {time.perf_counter() - started:.1f}s")
+
+
+def build_hnsw(args):
+    embeddings, records = load_source(bigquery.Client())
+    started = time.perf_counter()
+    backend = HNSWBackend.build(embeddings, records, m=args.m, ef_construction=args.ef_construction,
+                                ef_search=args.ef_search)
+    print(f"Built HNSW graph over {len(records)} pages in {time.perf_counter() - started:.1f}s")
+    backend.save(args.output)
+    print(f"Saved to {args.output}")
+    report_recall(backend, embeddings, records, args.k, args.samples)
+
+
+def train_ivfpq(args):
+    embeddings, records = load_source(bigquery.Client())
+    started = time.perf_counter()
+    backend = IVFPQBackend.train(embeddings, records, nlist=args.nlist, code_size=args.code_size,
+                                 nbits=args.nbits, nprobe=args.nprobe, train_size=args.train_size)
+    print(f"Trained IVF-PQ ({backend.index.nlist} lists, {args.code_size} bytes/code) "
+          f"over {len(records)} pages in {time.perf_counter() - started:.1f}s")
+    # The store already holds the full vectors for re-ranking; otherwise keep a copy beside the index
+    backend.save(args.output, None if open_store() is not None else embeddings)
+    print(f"Saved to {args.output} ({os.path.getsize(args.output) / 2**20:.1f} MiB, "
+          f"raw float32 matrix {embeddings.nbytes / 2**20:.1f} MiB)")
+    report_recall(backend, embeddings, records, args.k, args.samples)
+    if args.rerank:
+        backend.vectors, backend.rerank = embeddings, args.rerank
+        print(f"With exact re-rank of the top {args.rerank}x{args.k} candidates:")
+        report_recall(backend, embeddings, records, args.k, args.samples)
+
+
+def build_bm25(args):
+    store = open_store()
+    records = store.records if store is not None else load_records(bigquery.Client())
+    started = time.perf_counter()
+    index = BM25Index.build(args.output, records, k1=args.k1, b=args.b)
+    size = sum(os.path.getsize(os.path.join(args.output, name)) for name in os.listdir(args.output))
+    print(f"Indexed {index.num_rows} pages, {index.manifest['terms']} terms, into {args.output} "
+          f"({size / 2**20:.1f} MiB) in {time.perf_counter() - started:.1f}s")
+
+
+# Questions in the style users ask, added to any pages sampled from the store
+SAMPLE_QUERIES = [
+    "What is the humanitarian situation in Yemen?",
+    "Cholera outbreak response in Sudan 2023",
+    "How many people were displaced by the floods in Pakistan?",
+    "food insecurity IPC phase 4 Somalia",
+    "WASH needs in refugee camps",
+    "earthquake Türkiye Syria emergency appeal",
+    "OCHA funding gap for the Ethiopia HRP",
+    "protection of civilians in eastern DRC",
+]
+
+
+def export_model(args, quantization):
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+    onnx = args.backend.startswith("onnx")
+    model = SentenceTransformer(args.model, backend="onnx") if onnx else SentenceTransformer(args.model)
+    model.save(args.output)
+    if args.backend == "onnx-int8":
+        export_dynamic_quantized_onnx_model(model, quantization, args.output)
+    # torch-int8 is quantized when loaded, from the saved float32 weights
+    print(f"Saved {args.model} for the {args.backend} backend to {args.output}")
+
+
+def check_model(args):
+    quantization = os.getenv("ONNX_QUANTIZATION", "avx2")
+    if args.output:
+        export_model(args, quantization)
+    texts = list(SAMPLE_QUERIES)
+    store = open_store()
+    if store is not None:
+        rng = np.random.default_rng(0)
+        for i in rng.choice(len(store.records), size=min(args.samples, len(store.records)), replace=False):
+            record = store.records[i]
+            texts.append(f"{record.get('title') or ''} {record.get('combined_details') or ''}"[:1000])
+
+    reference = load_model(args.model, "torch")
+    candidate = load_model(args.output or args.model, args.backend)
+    print(f"Comparing {args.backend} to torch float32 on {len(texts)} texts"
+          + (f" ({onnx_int8_file(quantization)})" if args.backend == "onnx-int8" else ""))
+
+    expected = reference.encode(texts, normalize_embeddings=True)
+    actual = candidate.encode(texts, normalize_embeddings=True)
+    cosines = np.sum(expected * actual, axis=1)
+    print(f"cosine to torch float32: mean {cosines.mean():.5f}, min {cosines.min():.5f} (required {args.min_cosine})")
+
+    for name, model in (("torch", reference), (args.backend, candidate)):
+        model.encode(texts[0])
+        started = time.perf_counter()
+        for text in texts:
+            model.encode(text)
+        print(f"{name}: {(time.perf_counter() - started) / len(texts) * 1000:.1f} ms per query")
+
+    if cosines.min() < args.min_cosine:
+        raise SystemExit(f"{args.backend} embeddings are not within {args.min_cosine} cosine of the stored ones")
+
+
+def export_reranker(args):
+    from sentence_transformers import CrossEncoder
+    CrossEncoder(args.model).save(args.output)
+    print(f"Saved {args.model} to {args.output}")
+
+
+def bq_index(args):
+    client = bigquery.Client()
+    if not args.status:
+        started = time.perf_counter()
+        create_vector_index(client, args.type, num_lists=args.num_lists,
+                            leaf_node_embedding_count=args.leaf_node_embedding_count)
+        print(f"Created {args.type} vector index {VECTOR_INDEX} in {time.perf_counter() - started:.1f}s; "
+              "BigQuery builds it in the background")
+    rows = vector_index_status(client)
+    if not rows:
+        print(f"No vector index {VECTOR_INDEX}; queries use ML.DISTANCE")
+    for row in rows:
+        print(f"{row['index_name']}: {row['index_status']}, {row['coverage_percentage']}% covered, "
+              f"last refreshed {row['last_refresh_time']}"
+              + (f", disabled: {row['disable_reason']}" if row["disable_reason"] else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build retrieval indexes for the similarity API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    store = commands.add_parser("store", help="export pages_metadata to a memory-mapped embedding store")
+    store.add_argument("--output", default=os.getenv("EMBEDDING_STORE", "store"))
+    store.add_argument("--dtype", choices=["float32", "float16"], default="float32",
+                       help="float16 halves the vector file at a negligible loss in cosine precision")
+    store.set_defaults(func=export_store)
+
+    hnsw = commands.add_parser("hnsw", help="build and save an HNSW graph index")
+    hnsw.add_argument("--output", default=os.getenv("HNSW_INDEX_PATH", "indexes/hnsw.faiss"))
+    hnsw.add_argument("--m", type=int, default=int(os.getenv("HNSW_M", 32)))
+    hnsw.add_argument("--ef-construction", type=int, default=int(os.getenv("HNSW_EF_CONSTRUCTION", 200)))
+    hnsw.add_argument("--ef-search", type=int, default=int(os.getenv("HNSW_EF_SEARCH", 64)))
+    hnsw.add_argument("--k", type=int, default=10, help="k used for the recall report")
+    hnsw.add_argument("--samples", type=int, default=1000, help="queries used for the recall report")
+    hnsw.set_defaults(func=build_hnsw)
+
+    ivfpq = commands.add_parser("ivfpq", help="train and save an IVF-PQ compressed index")
+    ivfpq.add_argument("--output", default=os.getenv("IVFPQ_INDEX_PATH", "indexes/ivfpq.faiss"))
+    ivfpq.add_argument("--nlist", type=int, default=None, help="inverted lists (default ~4*sqrt(pages))")
+    ivfpq.add_argument("--code-size", type=int, default=48, help="PQ bytes per vector; must divide 384")
+    ivfpq.add_argument("--nbits", type=int, default=8, help="bits per PQ sub-code")
+    ivfpq.add_argument("--nprobe", type=int, default=int(os.getenv("IVFPQ_NPROBE", 16)))
+    ivfpq.add_argument("--rerank", type=int, default=4,
+                       help="also report recall with exact re-rank of rerank*k candidates (0 to skip)")
+    ivfpq.add_argument("--train-size", type=int, default=100_000, help="pages sampled for training")
+    ivfpq.add_argument("--k", type=int, default=10, help="k used for the recall report")
+    ivfpq.add_argument("--samples", type=int, default=1000, help="queries used for the recall report")
+    ivfpq.set_defaults(func=train_ivfpq)
+
+    index = commands.add_parser("bq-index", help="create or refresh the BigQuery vector index used by VECTOR_SEARCH")
+    index.add_argument("--type", choices=["IVF", "TREE_AH"], default="IVF")
+    index.add_argument("--num-lists", type=int, default=None, help="IVF lists (default chosen by BigQuery)")
+    index.add_argument("--leaf-node-embedding-count", type=int, default=None,
+                       help="TREE_AH leaf size (default chosen by BigQuery)")
+    index.add_argument("--status", action="store_true", help="only print the index status")
+    index.set_defaults(func=bq_index)
+
+    bm25 = commands.add_parser("bm25", help="build the BM25 keyword index used for hybrid search")
+    bm25.add_argument("--output", default=os.getenv("LEXICAL_INDEX_PATH", "indexes/bm25"))
+    bm25.add_argument("--k1", type=float, default=1.2, help="term frequency saturation")
+    bm25.add_argument("--b", type=float, default=0.75, help="document length normalization")
+    bm25.set_defaults(func=build_bm25)
+
+    model = commands.add_parser("model", help="export the embedding model for a backend and check its embeddings")
+    model.add_argument("--backend", choices=MODEL_BACKENDS, default=os.getenv("EMBEDDING_BACKEND", "onnx-int8"))
+    model.add_argument("--model", default=MODEL_NAME, help="Hub id or directory of the float32 model")
+    model.add_argument("--output", default=None, help="directory to save the model to, for EMBEDDING_MODEL")
+    model.add_argument("--min-cosine", type=float, default=MIN_COSINE,
+                       help="fail unless every sample embedding is at least this close to the torch one")
+    model.add_argument("--samples", type=int, default=200, help="store pages added to the sample questions")
+    model.set_defaults(func=check_model)
+
+    reranker = commands.add_parser("reranker", help="save the cross-encoder re-ranking model, for RERANK_MODEL")
+    reranker.add_argument("--model", required=True, help="Hub id of the cross-encoder")
+    reranker.add_argument("--output", required=True)
+    reranker.set_defaults(func=export_reranker)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
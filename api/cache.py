@@ -0,0 +1,225 @@
+# Caches for the similarity API.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(text):
+    """Case- and whitespace-folded query text, so trivially different questions share entries."""
+    return " ".join(str(text).split()).casefold()
+
+
+def query_key(text):
+    return hashlib.sha256(normalize_query(text).encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe LRU map with an optional time-to-live and hit/miss counters."""
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, count=True):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self.ttl and time.monotonic() - item[1] > self.ttl:
+                del self._items[key]
+                item = None
+            if item is None:
+                self.misses += count
+                return None
+            self._items.move_to_end(key)
+            self.hits += count
+            return item[0]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = (value, time.monotonic())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None}
+
+
+class SQLiteVectorStore:
+    """Vectors keyed by string in a SQLite file, shared by every worker process on the host."""
+
+    # Every this many writes, rows beyond max_size (oldest first) are deleted
+    prune_every = 256
+
+    def __init__(self, path, max_size=100_000, ttl=None):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS vectors "
+                               "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, created REAL NOT NULL)")
+
+    def _connection(self):
+        # sqlite3 connections must not cross threads or fork(); keep one per thread and process
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute("SELECT vector, created FROM vectors WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.ttl and time.time() - row[1] > self.ttl):
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def put(self, key, vector):
+        with self._connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)",
+                               (key, np.asarray(vector, dtype=np.float32).tobytes(), time.time()))
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                connection.execute("DELETE FROM vectors WHERE key NOT IN "
+                                   "(SELECT key FROM vectors ORDER BY created DESC LIMIT ?)", (self.max_size,))
+
+
+class EmbeddingCache:
+    """Query embeddings cached by normalized text in front of an encoder.
+
+    Lookups go to an in-process LRU first, then to an optional SQLite file
+    shared by all workers; only misses on both reach the transformer.
+    """
+
+    def __init__(self, encoder, max_size=4096, ttl=None, shared=None):
+        self.encoder = encoder
+        self.memory = LRUCache(max_size, ttl)
+        self.shared = shared
+        self.shared_hits = 0
+
+    @classmethod
+    def from_config(cls, encoder):
+        ttl = float(os.getenv("EMBEDDING_CACHE_TTL", 0)) or None
+        max_size = int(os.getenv("EMBEDDING_CACHE_SIZE", 4096))
+        path = os.getenv("EMBEDDING_CACHE_PATH")
+        shared = None
+        if path:
+            shared = SQLiteVectorStore(path, int(os.getenv("EMBEDDING_CACHE_SHARED_SIZE", 100_000)), ttl)
+        return cls(encoder, max_size, ttl, shared)
+
+    def lookup(self, key):
+        vector = self.memory.get(key)
+        if vector is None and self.shared is not None:
+            vector = self.shared.get(key)
+            if vector is not None:
+                self.shared_hits += 1
+                self.memory.put(key, vector)
+        return vector
+
+    def store(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        # Shared between callers, so it must never be modified in place
+        vector.flags.writeable = False
+        self.memory.put(key, vector)
+        if self.shared is not None:
+            self.shared.put(key, vector)
+        return vector
+
+    def encode(self, text):
+        if self.memory.max_size <= 0 and self.shared is None:
+            return self.encoder.encode(text)
+        key = query_key(text)
+        vector = self.lookup(key)
+        if vector is None:
+            # all-MiniLM-L6-v2 is uncased, so the folded text embeds exactly like the original
+            vector = self.store(key, self.encoder.encode(normalize_query(text)))
+        return vector
+
+    def encode_many(self, texts):
+        """Embeddings of several texts; only the cache misses go to the encoder, in one batch."""
+        keys = [query_key(text) for text in texts]
+        vectors = [self.lookup(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            encoded = self.encoder.encode_many([normalize_query(texts[i]) for i in missing])
+            for i, vector in zip(missing, encoded):
+                vectors[i] = self.store(keys[i], vector)
+        return vectors
+
+    def stats(self):
+        return {**self.memory.stats(), "shared_hits": self.shared_hits if self.shared is not None else None}
+
+
+class ResultCache:
+    """Ranked /similarity results cached per (query, fields, filters) and corpus version.
+
+    Each entry remembers the k it was fetched with, so a request for a smaller
+    k is served from a prefix of a cached larger one. Entries from an older
+    corpus version are ignored, so a refresh of pages_metadata or of the
+    embedding store invalidates the cache without waiting for the TTL.
+    """
+
+    def __init__(self, max_size=1024, ttl=3600):
+        self.entries = LRUCache(max_size, ttl)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls):
+        return cls(int(os.getenv("RESULT_CACHE_SIZE", 1024)), float(os.getenv("RESULT_CACHE_TTL", 3600)) or None)
+
+    @property
+    def enabled(self):
+        return self.entries.max_size > 0
+
+    @staticmethod
+    def key(text, fields, filters):
+        payload = json.dumps([normalize_query(text), fields, filters], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key, k, version):
+        """The top-k results, or None if nothing cached for this version covers k."""
+        entry = self.entries.get(key, count=False)
+        if entry is not None:
+            cached_k, cached_version, results = entry
+            # Fewer results than were asked for means every match is already cached
+            if cached_version == version and (k <= cached_k or len(results) < cached_k):
+                self.hits += 1
+                return results[:k]
+        self.misses += 1
+        return None
+
+    def put(self, key, k, version, results):
+        entry = self.entries.get(key, count=False)
+        if entry is not None and entry[1] == version and entry[0] >= k:
+            return
+        self.entries.put(key, (k, version, results))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "max_size": self.entries.max_size, "hits": self.hits,
+                "misses": self.misses, "hit_rate": round(self.hits / lookups, 4) if lookups else None}
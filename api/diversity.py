@@ -0,0 +1,66 @@
+# Diversification of retrieved pages. Reports are split into page chunks, so the
+# best matches are often several pages of one report saying nearly the same thing.
+# Maximal marginal relevance trades relevance against similarity to the pages
+# already picked, and a per-report cap bounds how many chunks of one report
+# (`id`) are returned.
+
+import numpy as np
+
+
+def normalize(vectors):
+    # Same as backends.normalize; importing backends would pull in the BigQuery client
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def relevance(results):
+    """Relevance in [0, 1] of ranked results, from the score of the last stage that ranked them."""
+    for key in ("rerank_score", "score"):
+        if results and all(key in result for result in results):
+            scores = np.array([result[key] for result in results], dtype=np.float32)
+            spread = scores.max() - scores.min()
+            return (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+    # `similarity` is the cosine distance
+    return 1.0 - np.array([result["similarity"] for result in results], dtype=np.float32)
+
+
+def select(relevance, k, vectors=None, mmr_lambda=1.0, groups=None, max_per_group=0):
+    """Positions of up to k candidates, picked greedily.
+
+    Each step takes the best `mmr_lambda * relevance - (1 - mmr_lambda) * max
+    cosine to the picked vectors`; candidates of a group that reached
+    `max_per_group` picks are skipped. Pairwise similarities are computed once.
+    """
+    n = len(relevance)
+    redundancy = np.zeros(n, dtype=np.float32)
+    similarities = normalize(vectors) @ normalize(vectors).T if vectors is not None and mmr_lambda < 1 else None
+    available = np.ones(n, dtype=bool)
+    if groups is not None:
+        groups = np.unique(np.asarray(groups, dtype=str), return_inverse=True)[1]
+        picked_per_group = np.zeros(groups.max() + 1 if n else 0, dtype=np.int64)
+    picked = []
+    while len(picked) < k and available.any():
+        gain = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy if similarities is not None else relevance
+        best = int(np.argmax(np.where(available, gain, -np.inf)))
+        picked.append(best)
+        available[best] = False
+        if similarities is not None:
+            redundancy = np.maximum(redundancy, similarities[best]) if len(picked) > 1 else similarities[best]
+        if groups is not None and max_per_group:
+            picked_per_group[groups[best]] += 1
+            if picked_per_group[groups[best]] >= max_per_group:
+                available[groups == groups[best]] = False
+    return picked
+
+
+def diversify(results, k, mmr_lambda=None, max_per_report=0):
+    """Up to k of the ranked `results`, by MMR over their `embedding` (when mmr_lambda is set)
+    and with at most max_per_report results per report `id` (when set)."""
+    if not results:
+        return results
+    vectors = np.array([result["embedding"] for result in results], dtype=np.float32) if mmr_lambda is not None else None
+    groups = [result["id"] for result in results] if max_per_report else None
+    order = select(relevance(results), k, vectors, 1.0 if mmr_lambda is None else mmr_lambda, groups, max_per_report)
+    return [results[i] for i in order]
@@ -0,0 +1,128 @@
+# Query embedding for the similarity API.
+# A SentenceTransformer is much faster per text on a batch than on single
+# strings, so concurrent requests are gathered into micro-batches.
+#
+# The model can run on one of several CPU inference backends (EMBEDDING_BACKEND):
+#   torch       the float32 PyTorch model the stored page embeddings were made with
+#   torch-int8  the same with its Linear layers dynamically quantized to int8
+#   onnx        exported to ONNX Runtime
+#   onnx-int8   ONNX Runtime with int8 dynamically quantized weights
+# Query embeddings must stay close to the stored ones; `python build_index.py model
+# --backend ...` checks a backend against MIN_COSINE before it is deployed.
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+MODEL_BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+# Smallest cosine similarity accepted between a backend's embeddings and the torch float32 ones
+MIN_COSINE = 0.99
+
+
+def onnx_int8_file(quantization):
+    # The names sentence_transformers.export_dynamic_quantized_onnx_model gives its files
+    weights = "quint8" if quantization == "avx2" else "qint8"
+    return f"onnx/model_{weights}_{quantization}.onnx"
+
+
+def load_model(name=None, backend=None):
+    """The SentenceTransformer named by EMBEDDING_MODEL (a Hub id or local directory), run by EMBEDDING_BACKEND."""
+    from sentence_transformers import SentenceTransformer
+    name = name or os.getenv("EMBEDDING_MODEL", MODEL_NAME)
+    backend = (backend or os.getenv("EMBEDDING_BACKEND", "torch")).lower()
+    if backend == "torch":
+        return SentenceTransformer(name)
+    if backend == "torch-int8":
+        import torch
+        model = SentenceTransformer(name, device="cpu")
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if backend == "onnx":
+        return SentenceTransformer(name, backend="onnx", model_kwargs={"file_name": "onnx/model.onnx"})
+    if backend == "onnx-int8":
+        # avx2 runs on any x86-64 server CPU; avx512_vnni is faster where available, arm64 for ARM hosts
+        quantization = os.getenv("ONNX_QUANTIZATION", "avx2")
+        return SentenceTransformer(name, backend="onnx", model_kwargs={"file_name": onnx_int8_file(quantization)})
+    raise ValueError(f"Unknown embedding backend '{backend}', expected one of {list(MODEL_BACKENDS)}")
+
+
+class BatchingEncoder:
+    """Encodes texts from concurrent callers in shared `model.encode(batch)` calls.
+
+    A batch is dispatched once it holds `max_batch_size` texts, once `max_wait_ms`
+    have passed since its first text arrived, or as soon as no other caller is
+    waiting, so a lone request is never delayed.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5.0):
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._reset()
+        # Threads do not survive fork(), so a forked worker process starts afresh
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._worker = None
+
+    @classmethod
+    def from_config(cls, model):
+        return cls(model, max_batch_size=int(os.getenv("ENCODER_MAX_BATCH", 32)),
+                   max_wait_ms=float(os.getenv("ENCODER_MAX_WAIT_MS", 5)))
+
+    def encode(self, text):
+        """Embedding of one text, as a float32 NumPy vector."""
+        future = Future()
+        with self._lock:
+            self._waiting += 1
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="batching-encoder", daemon=True)
+                self._worker.start()
+        self._queue.put((text, future))
+        return future.result()
+
+    def encode_many(self, texts):
+        """Embeddings of a list of texts; already a batch, so encoded directly in one call.
+
+        The model still runs them in chunks of `max_batch_size`, which bounds the
+        activations of a 1000-query batch request.
+        """
+        return self.model.encode(list(texts), batch_size=self.max_batch_size)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            with self._lock:
+                others_waiting = self._waiting > len(batch)
+            if not others_waiting:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for text, _ in batch]
+            try:
+                vectors = self.model.encode(texts, batch_size=len(texts))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), vector in zip(batch, vectors):
+                    future.set_result(vector)
+            finally:
+                with self._lock:
+                    self._waiting -= len(batch)
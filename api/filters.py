@@ -0,0 +1,92 @@
+# Structured metadata filters applied before vector ranking.
+# A filter maps a column to one value or a list of accepted values, e.g.
+#   {"country_name": "Yemen", "year": [2023, 2024], "disaster": "Cholera"}
+# Values match case-insensitively on their string form; several values of one
+# column are OR-ed, several columns are AND-ed.
+
+import numpy as np
+
+FILTER_COLUMNS = ["country_name", "year", "disaster", "theme_name", "source"]
+
+
+def normalize_value(value):
+    return str(value).strip().lower()
+
+
+def resolve_filters(filters=None):
+    """Validate request filters into {column: [normalized values]}; empty means no filtering."""
+    if not filters:
+        return {}
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object mapping column names to values")
+    unknown = [column for column in filters if column not in FILTER_COLUMNS]
+    if unknown:
+        raise ValueError(f"Cannot filter on {unknown}, expected any of {FILTER_COLUMNS}")
+    resolved = {}
+    for column in FILTER_COLUMNS:
+        if column in filters and filters[column] not in (None, [], ""):
+            values = filters[column] if isinstance(filters[column], list) else [filters[column]]
+            resolved[column] = sorted({normalize_value(value) for value in values})
+    return resolved
+
+
+class FilterIndex:
+    """Posting lists of row ids per value of every filter column (CSR layout).
+
+    For each column: `values` (sorted distinct normalized values), `rows` (row ids
+    grouped by value, ascending within a value) and `offsets` into `rows`.
+    """
+
+    def __init__(self, columns, num_rows):
+        self.columns = columns
+        self.num_rows = num_rows
+
+    @classmethod
+    def build(cls, records):
+        columns = {}
+        values_per_column = {column: [] for column in FILTER_COLUMNS}
+        for record in records:
+            for column in FILTER_COLUMNS:
+                value = record.get(column)
+                values_per_column[column].append("" if value is None else normalize_value(value))
+        num_rows = 0
+        for column, row_values in values_per_column.items():
+            row_values = np.array(row_values)
+            num_rows = len(row_values)
+            values, inverse = np.unique(row_values, return_inverse=True)
+            rows = np.argsort(inverse, kind="stable").astype(np.int64)
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(inverse, minlength=len(values)))])
+            columns[column] = (values, rows, offsets)
+        return cls(columns, num_rows)
+
+    def save(self, path):
+        arrays = {"num_rows": np.array(self.num_rows)}
+        for column, (values, rows, offsets) in self.columns.items():
+            arrays.update({f"{column}.values": values, f"{column}.rows": rows, f"{column}.offsets": offsets})
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            columns = {column: (data[f"{column}.values"], data[f"{column}.rows"], data[f"{column}.offsets"])
+                       for column in FILTER_COLUMNS}
+            return cls(columns, int(data["num_rows"]))
+
+    def postings(self, column, value):
+        values, rows, offsets = self.columns[column]
+        position = np.searchsorted(values, value)
+        if position == len(values) or values[position] != value:
+            return rows[:0]
+        return rows[offsets[position]:offsets[position + 1]]
+
+    def mask(self, filters):
+        """Boolean row mask for resolved filters, or None when nothing is filtered."""
+        if not filters:
+            return None
+        mask = np.ones(self.num_rows, dtype=bool)
+        for column, values in filters.items():
+            column_mask = np.zeros(self.num_rows, dtype=bool)
+            for value in values:
+                column_mask[self.postings(column, value)] = True
+            mask &= column_mask
+        return mask
@@ -0,0 +1,57 @@
+# Production server settings: gunicorn -c gunicorn.conf.py api_app:app
+# Every value can be overridden through the environment of the container.
+
+import os
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+
+# Worker processes, each serving requests on a pool of threads, so one slow
+# BigQuery job no longer blocks other users
+workers = int(os.getenv("GUNICORN_WORKERS", 2))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+worker_class = "gthread"
+
+# Seconds a request may run before its worker is restarted, and the grace
+# period in-flight requests get on shutdown or reload
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Import the app once in the master. With STARTUP_MODE=preload (the default, and
+# the image's) that loads the model, index and embedding store there, and the
+# workers fork from it and share those pages copy-on-write instead of loading
+# their own. With STARTUP_MODE=background each worker loads its own copy after
+# the fork, answering /ready with 503 until it is done; memory then grows with
+# the number of workers.
+preload_app = True
+
+accesslog = "-"
+
+# The master only loads; each worker warms up after the fork (see post_fork).
+# Running torch or faiss in the master would start OpenMP thread pools that do
+# not survive fork() and can hang the workers.
+os.environ.setdefault("WARM_UP_AFTER_FORK", "1")
+
+
+def post_fork(server, worker):
+    import service
+
+    # Network clients must not be shared across fork()
+    service.reset_client()
+
+    # Split the CPU between workers rather than letting each use every core
+    num_threads = int(os.getenv("TORCH_NUM_THREADS", 0)) or max(1, (os.cpu_count() or 1) // workers)
+
+    def limit_threads():
+        # torch and faiss are imported by service.load(), so this waits for it
+        if "torch" in sys.modules:
+            sys.modules["torch"].set_num_threads(num_threads)
+        if "faiss" in sys.modules:
+            # One query at a time per request thread; also avoids reusing the master's OpenMP pool
+            sys.modules["faiss"].omp_set_num_threads(1)
+
+    service.on_load(limit_threads)
+    service.on_load(service.warm_up_worker)
+    if service.STARTUP_MODE == "background":
+        service.start_loading()
@@ -0,0 +1,205 @@
+# BM25 keyword index over the page text, for exact matches on place names,
+# disaster codes and acronyms that the embedding model blurs.
+# An index is a directory holding:
+#   terms.bin, terms.idx.npy    sorted vocabulary, UTF-8, and the byte offset of every term
+#   postings.npy                per term: (row delta, term frequency) pairs as LEB128 varints
+#   postings.idx.npy            byte offset of every term's postings (plus the end)
+#   doc_lengths.npy             tokens per row
+#   uuids.npy                   uuid of every row, to match hits with the dense results
+#   filters.npz                 posting lists of the filter columns (see filters.py)
+#   manifest.json               row count, average length, k1 and b
+# Everything is memory-mapped; a query only touches the postings of its own terms.
+
+import datetime
+import json
+import mmap
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from filters import FilterIndex
+
+# Columns whose text is indexed
+TEXT_COLUMNS = ["title", "combined_details", "document"]
+# Longer tokens (URLs, base64 noise) are not indexed
+MAX_TOKEN_CHARS = 40
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return [token for token in TOKEN.findall(str(text).lower()) if len(token) <= MAX_TOKEN_CHARS]
+
+
+def varint_encode(values):
+    """LEB128 bytes of non-negative integers, as one uint8 array."""
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = varint_sizes(values)
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    starts = np.cumsum(sizes) - sizes
+    for j in range(int(sizes.max()) if len(sizes) else 0):
+        selected = sizes > j
+        byte = (values[selected] >> np.uint64(7 * j)) & np.uint64(0x7F)
+        more = (sizes[selected] > j + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[selected] + j] = byte | more
+    return out
+
+
+def varint_sizes(values):
+    sizes = np.ones(len(values), dtype=np.int64)
+    for j in range(1, 10):
+        sizes += values >= np.uint64(1 << (7 * j))
+    return sizes
+
+
+def varint_decode(data):
+    """Inverse of varint_encode."""
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.uint64)
+    starts = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], starts[:-1] + 1])
+    # Each byte's 7 payload bits, shifted by its position within its varint
+    position = np.arange(len(data)) - np.repeat(starts, np.diff(np.append(starts, len(data))))
+    parts = (data & 0x7F).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts)
+
+
+class BM25Index:
+    def __init__(self, path):
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.path = path
+        self.k1 = self.manifest["k1"]
+        self.b = self.manifest["b"]
+        self.num_rows = self.manifest["rows"]
+        self.avg_length = self.manifest["avg_length"] or 1.0
+        with open(os.path.join(path, "terms.bin"), "rb") as f:
+            # mmap cannot map an empty file
+            self.terms = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        self.term_offsets = np.load(os.path.join(path, "terms.idx.npy"), mmap_mode="r")
+        self.postings = np.load(os.path.join(path, "postings.npy"), mmap_mode="r")
+        self.posting_offsets = np.load(os.path.join(path, "postings.idx.npy"), mmap_mode="r")
+        self.doc_lengths = np.load(os.path.join(path, "doc_lengths.npy"), mmap_mode="r")
+        self.uuids = np.load(os.path.join(path, "uuids.npy"), mmap_mode="r")
+        self.filter_index = FilterIndex.load(os.path.join(path, "filters.npz"))
+
+    @property
+    def version(self):
+        return self.manifest["created"]
+
+    @staticmethod
+    def build(path, records, k1=1.2, b=0.75):
+        """Index the TEXT_COLUMNS of `records` into `path`."""
+        rows = {}
+        doc_lengths = []
+        for i, record in enumerate(records):
+            tokens = tokenize(" ".join(str(record.get(column) or "") for column in TEXT_COLUMNS))
+            doc_lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                rows.setdefault(term, []).append((i, count))
+        terms = sorted(rows)
+
+        # Per term: row deltas (the first one absolute) interleaved with frequencies
+        values, counts = [], []
+        for term in terms:
+            pairs = np.array(rows[term], dtype=np.uint64)
+            deltas = np.diff(pairs[:, 0], prepend=np.uint64(0))
+            values.append(np.column_stack([deltas, pairs[:, 1]]).ravel())
+            counts.append(2 * len(pairs))
+        values = np.concatenate(values) if values else np.empty(0, dtype=np.uint64)
+        sizes = varint_sizes(values)
+        bounds = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        posting_offsets = np.concatenate([[0], np.cumsum(sizes)])[bounds].astype(np.uint64)
+
+        encoded = [term.encode("utf-8") for term in terms]
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "terms.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+        np.save(os.path.join(path, "terms.idx.npy"),
+                np.concatenate([[0], np.cumsum([len(term) for term in encoded])]).astype(np.uint64))
+        np.save(os.path.join(path, "postings.npy"), varint_encode(values))
+        np.save(os.path.join(path, "postings.idx.npy"), posting_offsets)
+        np.save(os.path.join(path, "doc_lengths.npy"), np.array(doc_lengths, dtype=np.uint32))
+        np.save(os.path.join(path, "uuids.npy"), np.array([r["uuid"] for r in records]))
+        FilterIndex.build(records).save(os.path.join(path, "filters.npz"))
+
+        manifest = {"rows": len(doc_lengths), "terms": len(terms),
+                    "avg_length": float(np.mean(doc_lengths)) if doc_lengths else 0.0, "k1": k1, "b": b,
+                    "created": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return BM25Index(path)
+
+    def term_id(self, term):
+        """Position of `term` in the vocabulary, or None; binary search over the mapped terms."""
+        term = term.encode("utf-8")
+        low, high = 0, len(self.term_offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.terms[int(self.term_offsets[middle]):int(self.term_offsets[middle + 1])] < term:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.term_offsets) - 1 and \
+                self.terms[int(self.term_offsets[low]):int(self.term_offsets[low + 1])] == term:
+            return low
+        return None
+
+    def term_postings(self, term_id):
+        """(row ids, term frequencies) of one term."""
+        start, end = int(self.posting_offsets[term_id]), int(self.posting_offsets[term_id + 1])
+        values = varint_decode(self.postings[start:end])
+        return np.cumsum(values[0::2]).astype(np.int64), values[1::2].astype(np.float32)
+
+    def top_k(self, text, k, filters=None):
+        """(uuids, BM25 scores) of the k best rows for `text` among those matching `filters`."""
+        term_ids = {t for t in (self.term_id(token) for token in set(tokenize(text))) if t is not None}
+        if not term_ids or k <= 0:
+            return self.uuids[:0], np.empty(0, dtype=np.float32)
+        mask = self.filter_index.mask(filters)
+        rows, weights = [], []
+        for term_id in term_ids:
+            ids, tf = self.term_postings(term_id)
+            # Document frequency over the whole corpus, so filtering doesn't change the weights
+            df = len(ids)
+            if mask is not None:
+                keep = mask[ids]
+                ids, tf = ids[keep], tf[keep]
+            idf = np.log1p((self.num_rows - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[ids] / self.avg_length)
+            rows.append(ids)
+            weights.append(idf * tf * (self.k1 + 1) / (tf + norm))
+        # Sum the contributions of every term per row, touching only rows that contain one
+        rows, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        if not len(rows):
+            return self.uuids[:0], np.empty(0, dtype=np.float32)
+        scores = np.bincount(inverse, weights=np.concatenate(weights)).astype(np.float32)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return self.uuids[rows[top]], scores[top]
+
+
+def open_lexical():
+    """The BM25Index at LEXICAL_INDEX_PATH, or None when hybrid search is off."""
+    path = os.getenv("LEXICAL_INDEX_PATH")
+    return BM25Index(path) if path else None
+
+
+def reciprocal_rank_fusion(rankings, rrf_k=60):
+    """{key: fused score} of several best-first rankings of keys."""
+    fused = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return fused
+
+
+def weighted_fusion(dense, lexical, alpha=0.5):
+    """{key: alpha * cosine + (1 - alpha) * BM25 / best BM25} of {key: score} maps."""
+    best = max(lexical.values(), default=0.0) or 1.0
+    return {key: alpha * dense.get(key, 0.0) + (1 - alpha) * lexical.get(key, 0.0) / best
+            for key in dense.keys() | lexical.keys()}
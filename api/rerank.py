@@ -0,0 +1,69 @@
+# Optional second stage of /similarity: a cross-encoder reads each (query, page)
+# pair of a larger candidate pool and re-scores it, which orders the top few
+# results far more precisely than cosine distance alone. The stage has a time
+# budget; when it would overrun, the candidates keep their retrieval order.
+
+import os
+import threading
+import time
+
+# Columns a passage is built from; fetched for the candidates even if the client didn't ask for them
+PASSAGE_COLUMNS = ["title", "document"]
+
+
+class CrossEncoderReranker:
+    def __init__(self, model, budget_ms=300, batch_size=8, max_chars=1000):
+        self.model = model
+        self.budget_ms = budget_ms
+        self.batch_size = batch_size
+        self.max_chars = max_chars
+        # Running estimate of the cost of one pair, so a batch that cannot finish in time is not started
+        self.seconds_per_pair = None
+        self.reranked = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        """A re-ranker for RERANK_MODEL (e.g. cross-encoder/ms-marco-MiniLM-L-6-v2), or None when unset."""
+        name = os.getenv("RERANK_MODEL")
+        if not name:
+            return None
+        from sentence_transformers import CrossEncoder
+        model = CrossEncoder(name, max_length=int(os.getenv("RERANK_MAX_LENGTH", 256)))
+        return cls(model, budget_ms=float(os.getenv("RERANK_BUDGET_MS", 300)),
+                   batch_size=int(os.getenv("RERANK_BATCH_SIZE", 8)),
+                   max_chars=int(os.getenv("RERANK_MAX_CHARS", 1000)))
+
+    def passage(self, result):
+        return " ".join(str(result.get(column) or "") for column in PASSAGE_COLUMNS)[:self.max_chars]
+
+    def rerank(self, query, results, k):
+        """(top-k results by cross-encoder score, True), or (the first k as given, False) out of time.
+
+        Re-ranked results gain a `rerank_score`.
+        """
+        deadline = time.perf_counter() + self.budget_ms / 1000
+        pairs = [(query, self.passage(result)) for result in results]
+        scores = []
+        for start in range(0, len(pairs), self.batch_size):
+            batch = pairs[start:start + self.batch_size]
+            started = time.perf_counter()
+            if self.seconds_per_pair is not None and started + len(batch) * self.seconds_per_pair > deadline:
+                with self._lock:
+                    self.fallbacks += 1
+                    # Decay the estimate so the stage is tried again once load drops
+                    self.seconds_per_pair *= 0.9
+                return results[:k], False
+            scores.extend(self.model.predict(batch, batch_size=self.batch_size, show_progress_bar=False).tolist())
+            cost = (time.perf_counter() - started) / len(batch)
+            with self._lock:
+                self.seconds_per_pair = cost if self.seconds_per_pair is None else (self.seconds_per_pair + cost) / 2
+        with self._lock:
+            self.reranked += 1
+        order = sorted(range(len(results)), key=lambda i: scores[i], reverse=True)[:k]
+        return [{**results[i], "rerank_score": scores[i]} for i in order], True
+
+    def stats(self):
+        return {"reranked": self.reranked, "fallbacks": self.fallbacks,
+                "ms_per_pair": round(self.seconds_per_pair * 1000, 3) if self.seconds_per_pair else None}
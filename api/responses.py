@@ -0,0 +1,143 @@
+# Response encoding for the similarity API: fast JSON serialization and
+# compression negotiated from the client's Accept-Encoding header.
+
+import gzip
+import os
+import zlib
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encodings the server may use, in order of preference; brotli and zstd need their packages
+SUPPORTED = [name for name, available in (("zstd", zstandard), ("br", brotli), ("gzip", True)) if available]
+ENCODINGS = [name for name in os.getenv("RESPONSE_COMPRESSION", ",".join(SUPPORTED)).replace(" ", "").split(",")
+             if name in SUPPORTED]
+# Bodies smaller than this are sent as they are; compressing them costs more than it saves
+MIN_SIZE = int(os.getenv("COMPRESS_MIN_BYTES", 1024))
+
+# Fast settings: responses are compressed on every request, not once ahead of time
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON through orjson when installed: native dates (ISO 8601), numpy scalars and arrays.
+
+    Types orjson does not know go through Flask's usual default handler.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.get("indent"):
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode("utf-8")
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def negotiate(accept_encoding):
+    """The best encoding the client accepts, or None to send the body uncompressed."""
+    if not accept_encoding or not ENCODINGS:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for name in ENCODINGS:
+        q = weights.get(name, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def compress(data, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class StreamCompressor:
+    """Compresses a streamed body chunk by chunk, flushing after each so no line is held back."""
+
+    def __init__(self, encoding):
+        if encoding == "zstd":
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._compress = compressor.compress
+            self._flush = lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            self._finish = compressor.flush
+        elif encoding == "br":
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._compress, self._flush, self._finish = compressor.process, compressor.flush, compressor.finish
+        else:
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip container
+            self._compress = compressor.compress
+            self._flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = compressor.flush
+
+    def compress(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        return self._compress(chunk) + self._flush()
+
+    def finish(self):
+        return self._finish()
+
+
+def compress_chunks(chunks, encoding):
+    compressor = StreamCompressor(encoding)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.finish()
+
+
+def compressible(response):
+    return (response.status_code != 304 and "Content-Encoding" not in response.headers
+            and response.mimetype in ("application/json", "application/x-ndjson"))
+
+
+def compress_response(response, accept_encoding):
+    """Flask after_request hook body: compress a JSON or NDJSON response if the client allows it."""
+    if not compressible(response) or response.direct_passthrough:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate(accept_encoding)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
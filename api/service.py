@@ -0,0 +1,451 @@
+# Components and search pipeline shared by the Flask app (api_app.py) and the
+# asyncio app (async_app.py): the embedding model, caches and retrieval backend,
+# request parsing, and cached single/batch search.
+#
+# The heavy components (torch and the model, the BigQuery client, the index) are
+# created by load(), when STARTUP_MODE says:
+#   preload     while this module is imported; under gunicorn that is once, in the
+#               master, and the workers share the loaded pages copy-on-write
+#   background  in a thread each server process starts, so it accepts connections
+#               (and answers /ready with 503) while loading
+#   lazy        on the first request that needs them
+# Either way a request never sees a half-loaded service: it waits for load().
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from backends import LocalBackend, load_backend, resolve_fields
+from cache import EmbeddingCache, ResultCache
+from diversity import diversify
+from encoder import BatchingEncoder, load_model
+from filters import resolve_filters
+from lexical import open_lexical, reciprocal_rank_fusion, weighted_fusion
+from rerank import PASSAGE_COLUMNS, CrossEncoderReranker
+
+STARTUP_MODE = os.getenv("STARTUP_MODE", "preload").lower()
+# Leave the warm-up to warm_up_worker(), called in each process after a fork; gunicorn.conf.py
+# sets this so the master never starts torch or OpenMP thread pools that a fork would inherit
+WARM_UP_AFTER_FORK = os.getenv("WARM_UP_AFTER_FORK", "").lower() in ("1", "true", "yes")
+
+# Set by load():
+# all-MiniLM-L6-v2 by default; EMBEDDING_MODEL / EMBEDDING_BACKEND select a path and inference backend
+model = None
+# Concurrent requests share encode() calls (ENCODER_MAX_BATCH / ENCODER_MAX_WAIT_MS)
+encoder = None
+# Repeated questions skip the transformer (EMBEDDING_CACHE_SIZE / _TTL / _PATH)
+embedding_cache = None
+client = None
+backend = None
+# BM25 keyword index fused with the dense ranking (LEXICAL_INDEX_PATH; unset: dense only)
+lexical = None
+# Cross-encoder re-ranking of a larger candidate pool (RERANK_MODEL; unset: off)
+reranker = None
+
+# Popular questions skip the backend too (RESULT_CACHE_SIZE / RESULT_CACHE_TTL)
+result_cache = ResultCache.from_config()
+
+# Server-wide cap on the length of the returned `document` text (unset: full page)
+PREVIEW_CHARS = int(os.getenv("DOCUMENT_PREVIEW_CHARS", 0)) or None
+# On a result-cache miss at least this many results are fetched, so later smaller-k requests hit
+RESULT_CACHE_FETCH_K = int(os.getenv("RESULT_CACHE_FETCH_K", 10))
+# Largest number of queries accepted by /similarity/batch
+MAX_BATCH_QUERIES = int(os.getenv("MAX_BATCH_QUERIES", 1000))
+# Hybrid search: "rrf" (reciprocal rank fusion) or "weighted" (HYBRID_ALPHA * cosine + rest * BM25),
+# over this many candidates from each of the dense and keyword rankings
+HYBRID_FUSION = os.getenv("HYBRID_FUSION", "rrf").lower()
+HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", 0.5))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 50))
+RRF_K = int(os.getenv("RRF_K", 60))
+# Candidates retrieved for the re-ranker to choose the top k from
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 30))
+# Diversification: maximal marginal relevance (MMR_LAMBDA, 1 = relevance only; unset: off) and at
+# most MAX_CHUNKS_PER_REPORT pages per report id (0: no cap), over DIVERSITY_CANDIDATES candidates
+MMR_LAMBDA = float(os.environ["MMR_LAMBDA"]) if os.getenv("MMR_LAMBDA") else None
+MAX_CHUNKS_PER_REPORT = int(os.getenv("MAX_CHUNKS_PER_REPORT", 0))
+DIVERSITY_CANDIDATES = int(os.getenv("DIVERSITY_CANDIDATES", 30))
+DIVERSIFY = MMR_LAMBDA is not None or MAX_CHUNKS_PER_REPORT > 0
+
+
+_loaded = threading.Event()
+_load_lock = threading.Lock()
+# Seconds spent on each startup step, reported by /ready
+startup_timings = {}
+load_error = None
+# Called once the components exist (see on_load)
+_load_callbacks = []
+
+
+def new_client():
+    from google.cloud import bigquery
+    return bigquery.Client()
+
+
+def load():
+    """Create every component once; later calls return at once (or wait for the first to finish)."""
+    global model, encoder, embedding_cache, client, backend, lexical, reranker, load_error
+    if _loaded.is_set():
+        return
+    with _load_lock:
+        if _loaded.is_set():
+            return
+        timings = {}
+
+        def step(name, function, *args):
+            started = time.perf_counter()
+            value = function(*args)
+            timings[name] = round(time.perf_counter() - started, 3)
+            return value
+
+        try:
+            model = step("model", load_model)
+            encoder = BatchingEncoder.from_config(model)
+            embedding_cache = EmbeddingCache.from_config(encoder)
+            client = step("bigquery_client", new_client)
+            backend = step("backend", load_backend, client)
+            lexical = step("lexical_index", open_lexical)
+            reranker = step("reranker", CrossEncoderReranker.from_config)
+            if not WARM_UP_AFTER_FORK:
+                step("warm_up", warm_up)
+        except Exception as e:
+            load_error = f"{type(e).__name__}: {e}"
+            print(f"Startup failed after {json.dumps(timings)}: {load_error}")
+            raise
+        timings["total"] = round(sum(timings.values()), 3)
+        startup_timings.update(timings)
+        load_error = None
+        print(f"Startup ({STARTUP_MODE}) in {timings['total']}s: {json.dumps(timings)}")
+        for callback in _load_callbacks:
+            callback()
+        _loaded.set()
+
+
+def on_load(callback):
+    """Call `callback` once the components are loaded: now if they are, else at the end of load()."""
+    with _load_lock:
+        if _loaded.is_set():
+            callback()
+        else:
+            _load_callbacks.append(callback)
+
+
+def warm_up():
+    # The first forward pass and the first search pay one-off costs (allocations, page faults);
+    # pay them before traffic does. BigQuery is not queried, as that would be billed.
+    vector = model.encode(["warm-up query"])[0]
+    if isinstance(backend, LocalBackend):
+        backend.search(vector.tolist(), 1)
+    if reranker is not None:
+        reranker.model.predict([("warm-up query", "warm-up passage")], show_progress_bar=False)
+
+
+def warm_up_worker():
+    """warm_up() in this worker process, adding its time to startup_timings."""
+    started = time.perf_counter()
+    warm_up()
+    startup_timings["warm_up"] = round(time.perf_counter() - started, 3)
+    startup_timings["total"] = round(sum(v for name, v in startup_timings.items() if name != "total"), 3)
+    print(f"Warm-up in {startup_timings['warm_up']}s")
+
+
+def ready():
+    return _loaded.is_set()
+
+
+def start_loading():
+    """Load in a background thread of this process, unless loaded or already loading."""
+    if ready() or _load_lock.locked():
+        return
+
+    def run():
+        try:
+            load()
+        except Exception:
+            pass  # Reported through load_error; the next request or /ready tries again
+
+    threading.Thread(target=run, name="startup", daemon=True).start()
+
+
+def readiness():
+    """(body, status) of a readiness probe: 200 once loaded, 503 while loading, 500 if loading failed.
+
+    A probe also starts loading when nothing else has.
+    """
+    if ready():
+        return {"ready": True, "startup": startup_timings}, 200
+    if load_error is not None and not _load_lock.locked():
+        start_loading()
+        return {"ready": False, "error": load_error}, 500
+    start_loading()
+    return {"ready": False}, 503
+
+
+def reset_client():
+    """Give this process its own BigQuery client, e.g. in a freshly forked worker."""
+    global client
+    if client is None:
+        # Not loaded yet: load() will create this process's client
+        return
+    client = new_client()
+    if hasattr(backend, "client"):
+        backend.client = client
+
+
+def parse_k(value):
+    try:
+        k = int(value)
+    except TypeError:
+        # `"k": null` or a list; int() raises ValueError itself for strings
+        raise ValueError("k must be an integer")
+    if k < 1:
+        raise ValueError("k must be at least 1")
+    return k
+
+
+def parse_preview_chars(value):
+    try:
+        preview_chars = int(value or 0)
+    except TypeError:
+        raise ValueError("preview_chars must be an integer")
+    if preview_chars < 0:
+        raise ValueError("preview_chars must not be negative")
+    return preview_chars or PREVIEW_CHARS
+
+
+def parse_query(data):
+    """(text, k, fields, filters, preview_chars) of a /similarity body; ValueError if invalid."""
+    input_text = data.get("text")
+    k = parse_k(data.get("k", 10))  # Default to 10 items if k is not provided
+    # Columns to return, e.g. ["title", "URL"] or "*"; a lean projection by default
+    fields = resolve_fields(data.get("fields"))
+    # Metadata filters applied before ranking, e.g. {"country_name": "Yemen", "year": 2023}
+    filters = resolve_filters(data.get("filters"))
+    preview_chars = parse_preview_chars(data.get("preview_chars"))
+    if not input_text:
+        raise ValueError("Text input is required")
+    return input_text, k, fields, filters, preview_chars
+
+
+def parse_batch(data):
+    """(texts, ks, fields, filters, preview_chars) of a /similarity/batch body; ValueError if invalid.
+
+    k and filters given at the top level apply to queries that don't set their own.
+    """
+    queries = data.get("queries")
+    if not isinstance(queries, list) or not queries:
+        raise ValueError("A non-empty list of queries is required")
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise ValueError(f"At most {MAX_BATCH_QUERIES} queries per batch")
+    fields = resolve_fields(data.get("fields"))
+    texts, ks, filters = [], [], []
+    for query in queries:
+        query = {"text": query} if isinstance(query, str) else query
+        if not isinstance(query, dict) or not query.get("text"):
+            raise ValueError("Text input is required for every query")
+        texts.append(query["text"])
+        ks.append(parse_k(query.get("k", data.get("k", 10))))
+        filters.append(resolve_filters(query.get("filters", data.get("filters"))))
+    preview_chars = parse_preview_chars(data.get("preview_chars"))
+    return texts, ks, fields, filters, preview_chars
+
+
+def truncate_preview(result, preview_chars):
+    # Results may be shared with the result cache, so a truncated one is a copy
+    if not preview_chars or not isinstance(result.get("document"), str):
+        return result
+    return {**result, "document": result["document"][:preview_chars]}
+
+
+def truncate_previews(results, preview_chars):
+    return [truncate_preview(result, preview_chars) for result in results]
+
+
+def wants_stream(data, accept=""):
+    """Whether a /similarity request opted into an NDJSON response."""
+    return bool(data.get("stream")) or "application/x-ndjson" in (accept or "")
+
+
+def with_columns(fields, *columns):
+    # Stages that need columns the client didn't ask for fetch them too; `trim` drops them again
+    return fields + [column for column in columns if column not in fields]
+
+
+def trim(results, fields, *columns):
+    extra = [column for column in columns if column not in fields]
+    if not extra:
+        return results
+    return [{key: value for key, value in result.items() if key not in extra} for result in results]
+
+
+def fuse(k, fields, dense, hits, extra=()):
+    """Top-k of dense results (with uuids) and (uuids, BM25 scores) keyword hits, per HYBRID_FUSION.
+
+    `extra` holds the keyword hits missing from the dense results, with their
+    cosine distance, as far as the backend could return them; hits without a
+    page are left out. Each result gains the fused `score`, best first.
+    """
+    uuids, scores = hits
+    pages = {result["uuid"]: result for result in [*extra, *dense]}
+    keyword = {uuid: float(score) for uuid, score in zip(uuids.tolist(), scores) if uuid in pages}
+    if HYBRID_FUSION == "weighted":
+        fused = weighted_fusion({uuid: 1.0 - result["similarity"] for uuid, result in pages.items()},
+                                keyword, HYBRID_ALPHA)
+    else:
+        fused = reciprocal_rank_fusion([[result["uuid"] for result in dense], list(keyword)], RRF_K)
+    results = [{**pages[uuid], "score": fused[uuid]} for uuid in sorted(fused, key=fused.get, reverse=True)[:k]]
+    return trim(results, fields, "uuid")
+
+
+def retrieve(input_text, k, fields, filters):
+    """Backend top-k for a query, fused with the keyword index when one is configured."""
+    embedding = embedding_cache.encode(input_text).tolist()
+    if lexical is None:
+        return backend.search(embedding, k, fields, filters)
+    candidates = max(k, HYBRID_CANDIDATES)
+    hits = lexical.top_k(input_text, candidates, filters)
+    # The backend returns the keyword hits' pages after the dense ones, from the same search
+    results = backend.search(embedding, candidates, with_columns(fields, "uuid"), filters, hits[0].tolist())
+    return fuse(k, fields, results[:candidates], hits, results[candidates:])
+
+
+# Columns the re-ranking and diversity stages read
+STAGE_COLUMNS = PASSAGE_COLUMNS + ["id", "embedding"]
+
+
+def pool(k, fields):
+    """(candidates, fields) to retrieve for a final top-k: more, with the columns they read, per stage."""
+    candidates, columns = k, []
+    if reranker is not None:
+        candidates = max(candidates, RERANK_CANDIDATES)
+        columns += PASSAGE_COLUMNS
+    if DIVERSIFY:
+        candidates = max(candidates, DIVERSITY_CANDIDATES)
+        columns += ["id"] + (["embedding"] if MMR_LAMBDA is not None else [])
+    return candidates, with_columns(fields, *columns)
+
+
+def refine(input_text, results, k, fields):
+    """(top-k, complete) of retrieved candidates after re-ranking and diversification, when configured.
+
+    complete is False when re-ranking ran out of time.
+    """
+    complete = True
+    if reranker is not None:
+        results, complete = reranker.rerank(input_text, results, max(k, DIVERSITY_CANDIDATES) if DIVERSIFY else k)
+    if DIVERSIFY:
+        results = diversify(results, k, MMR_LAMBDA, MAX_CHUNKS_PER_REPORT)
+    return trim(results[:k], fields, *STAGE_COLUMNS), complete
+
+
+def rank(input_text, k, fields, filters):
+    """(top-k, complete) for a query: retrieval, then the optional re-ranking and diversity stages."""
+    candidates, pool_fields = pool(k, fields)
+    return refine(input_text, retrieve(input_text, candidates, pool_fields, filters), k, fields)
+
+
+def cache_results(key, k, version, results, complete):
+    # A re-ranking cut short by its budget is worth retrying next time. The per-report cap can
+    # return fewer than k results while more pages match, so such an entry only covers its length.
+    if not complete:
+        return
+    if DIVERSIFY and len(results) < k:
+        k = len(results)
+    result_cache.put(key, k, version, results)
+
+
+def embed(input_text):
+    """The query embedding /similarity searches with, through the embedding cache."""
+    load()
+    return embedding_cache.encode(input_text)
+
+
+def search(input_text, k, fields, filters):
+    """Top-k results for a query, from the result cache when possible."""
+    load()
+    if not result_cache.enabled:
+        return rank(input_text, k, fields, filters)[0]
+    key = result_cache.key(input_text, fields, filters)
+    version = backend.corpus_version()
+    results = result_cache.get(key, k, version)
+    if results is None:
+        fetch_k = max(k, RESULT_CACHE_FETCH_K)
+        results, complete = rank(input_text, fetch_k, fields, filters)
+        cache_results(key, fetch_k, version, results, complete)
+    return results[:k]
+
+
+def iter_search(input_text, k, fields, filters):
+    """Like search, but yields results as the backend produces them."""
+    load()
+    if lexical is not None or reranker is not None or DIVERSIFY:
+        # Fusion, re-ranking and diversification need every candidate before the first result is known
+        yield from search(input_text, k, fields, filters)
+        return
+    if not result_cache.enabled:
+        yield from backend.iter_search(embedding_cache.encode(input_text).tolist(), k, fields, filters)
+        return
+    key = result_cache.key(input_text, fields, filters)
+    version = backend.corpus_version()
+    results = result_cache.get(key, k, version)
+    if results is not None:
+        yield from results[:k]
+        return
+    fetch_k = max(k, RESULT_CACHE_FETCH_K)
+    results = []
+    for result in backend.iter_search(embedding_cache.encode(input_text).tolist(), fetch_k, fields, filters):
+        if len(results) < k:
+            yield result
+        results.append(result)
+    # Only a stream read to the end is complete enough to cache
+    result_cache.put(key, fetch_k, version, results)
+
+
+def search_batch(texts, ks, fields, filters):
+    """Top-k results for several queries: cache hits first, then one batched encode and search."""
+    load()
+    output = [None] * len(texts)
+    keys = [result_cache.key(text, fields, f) for text, f in zip(texts, filters)]
+    version = backend.corpus_version() if result_cache.enabled else None
+    if result_cache.enabled:
+        output = [result_cache.get(key, k, version) for key, k in zip(keys, ks)]
+    pending = [i for i, results in enumerate(output) if results is None]
+    if pending:
+        fetch_ks = [max(ks[i], RESULT_CACHE_FETCH_K) if result_cache.enabled else ks[i] for i in pending]
+        pool_ks = [pool(fetch_k, fields)[0] for fetch_k in fetch_ks]
+        pool_fields = pool(0, fields)[1]
+        embeddings = embedding_cache.encode_many([texts[i] for i in pending])
+        if lexical is None:
+            found = backend.search_batch(embeddings, pool_ks, pool_fields, [filters[i] for i in pending])
+        else:
+            candidates = [max(pool_k, HYBRID_CANDIDATES) for pool_k in pool_ks]
+            dense = backend.search_batch(embeddings, candidates, with_columns(pool_fields, "uuid"),
+                                         [filters[i] for i in pending])
+            found = []
+            for i, embedding, pool_k, n, results in zip(pending, embeddings, pool_ks, candidates, dense):
+                hits = lexical.top_k(texts[i], n, filters[i])
+                # Local indexes look the missing hits up in memory; a BigQuery batch would need another
+                # scan of the table for them, so there keyword hits only re-rank the dense candidates
+                extra = []
+                if isinstance(backend, LocalBackend):
+                    missing = np.setdiff1d(hits[0], [result["uuid"] for result in results])
+                    extra = backend.fetch(embedding, missing, with_columns(pool_fields, "uuid"))
+                found.append(fuse(pool_k, pool_fields, results, hits, extra))
+        for i, fetch_k, results in zip(pending, fetch_ks, found):
+            results, complete = refine(texts[i], results, fetch_k, fields)
+            if result_cache.enabled:
+                cache_results(keys[i], fetch_k, version, results, complete)
+            output[i] = results
+    return [results[:k] for results, k in zip(output, ks)]
+
+
+def stats():
+    return {"embedding_cache": embedding_cache.stats() if embedding_cache is not None else None,
+            "result_cache": result_cache.stats(),
+            "rerank": reranker.stats() if reranker is not None else None}
+
+
+if STARTUP_MODE == "preload":
+    load()
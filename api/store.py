@@ -0,0 +1,102 @@
+# On-disk embedding store shared by every API worker.
+# A store is a directory holding:
+#   vectors.npy             normalized embeddings, float32 or float16, one row per page
+#   metadata.jsonl          the pages_metadata columns, one JSON line per row
+#   metadata.jsonl.idx.npy  byte offset of every line (plus the end of file)
+#   uuids.npy               row order, used to check indexes built from the store
+#   filters.npz             posting lists of the filter columns (see filters.py)
+#   manifest.json           dtype, row count and export time
+# Both files are opened with mmap, so workers share the OS page cache instead of
+# each copying the corpus onto its heap, and opening a store is nearly instant.
+
+import datetime
+import json
+import mmap
+import os
+
+import numpy as np
+
+from filters import FilterIndex
+
+
+class MetadataFile:
+    """Row-indexed, read-only view of metadata.jsonl; rows are decoded on access."""
+
+    def __init__(self, path, date_columns=None):
+        self.offsets = np.load(path + ".idx.npy", mmap_mode="r")
+        # {column: "datetime" | "date"} for values to turn back into Python objects
+        self.date_columns = [(column, getattr(datetime, kind)) for column, kind in (date_columns or {}).items()]
+        with open(path, "rb") as f:
+            # mmap cannot map an empty file
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i = int(i) % len(self)
+        record = json.loads(self.data[int(self.offsets[i]):int(self.offsets[i + 1])])
+        for column, kind in self.date_columns:
+            if record.get(column):
+                record[column] = kind.fromisoformat(record[column])
+        return record
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class EmbeddingStore:
+    def __init__(self, path):
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.path = path
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.uuids = np.load(os.path.join(path, "uuids.npy"), mmap_mode="r")
+        self.records = MetadataFile(os.path.join(path, "metadata.jsonl"), self.manifest["date_columns"])
+        self.records.uuids = self.uuids
+        self.records.version = self.version
+        filters_path = os.path.join(path, "filters.npz")
+        self.records.filter_index = FilterIndex.load(filters_path) if os.path.exists(filters_path) else None
+
+    @property
+    def version(self):
+        return self.manifest["created"]
+
+    @staticmethod
+    def write(path, embeddings, records, dtype="float32"):
+        """Export row-aligned normalized embeddings and metadata records to `path`."""
+        if len(embeddings) != len(records):
+            raise ValueError("embeddings and records must be row-aligned")
+        if dtype not in ("float32", "float16"):
+            raise ValueError("dtype must be float32 or float16")
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "vectors.npy"), np.asarray(embeddings, dtype=dtype))
+        np.save(os.path.join(path, "uuids.npy"), np.array([r["uuid"] for r in records]))
+
+        date_columns = {}
+
+        def encode(value):
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                return value.isoformat()
+            return str(value)
+
+        offsets = [0]
+        with open(os.path.join(path, "metadata.jsonl"), "wb") as f:
+            for record in records:
+                for column, value in record.items():
+                    if isinstance(value, datetime.date):
+                        date_columns[column] = type(value).__name__
+                line = json.dumps(record, default=encode).encode("utf-8") + b"\n"
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+        np.save(os.path.join(path, "metadata.jsonl.idx.npy"), np.array(offsets, dtype=np.uint64))
+        FilterIndex.build(records).save(os.path.join(path, "filters.npz"))
+
+        manifest = {"rows": len(records), "dim": int(np.shape(embeddings)[1]) if len(records) else 0,
+                    "dtype": dtype, "date_columns": date_columns,
+                    "created": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return EmbeddingStore(path)
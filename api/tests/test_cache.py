@@ -0,0 +1,39 @@
+from cache import ResultCache
+
+RESULTS = [{"uuid": f"u{i}"} for i in range(10)]
+
+
+def test_smaller_k_is_served_from_a_larger_entry():
+    cache = ResultCache()
+    cache.put("q", 10, "v1", RESULTS)
+    assert cache.get("q", 3, "v1") == RESULTS[:3]
+    assert cache.get("q", 10, "v1") == RESULTS
+    assert cache.get("q", 11, "v1") is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_short_results_cover_any_k():
+    cache = ResultCache()
+    cache.put("q", 10, "v1", RESULTS[:4])
+    assert cache.get("q", 50, "v1") == RESULTS[:4]
+
+
+def test_smaller_k_does_not_replace_a_larger_entry():
+    cache = ResultCache()
+    cache.put("q", 10, "v1", RESULTS)
+    cache.put("q", 2, "v1", RESULTS[:2])
+    assert cache.get("q", 10, "v1") == RESULTS
+
+
+def test_new_version_invalidates():
+    cache = ResultCache()
+    cache.put("q", 10, "v1", RESULTS)
+    assert cache.get("q", 3, "v2") is None
+    cache.put("q", 3, "v2", RESULTS[5:8])
+    assert cache.get("q", 3, "v2") == RESULTS[5:8]
+    assert cache.get("q", 3, "v1") is None
+
+
+def test_key_folds_case_and_whitespace():
+    assert ResultCache.key("Sudan  Cholera", ["uuid"], {}) == ResultCache.key(" sudan cholera", ["uuid"], {})
+    assert ResultCache.key("sudan", ["uuid"], {}) != ResultCache.key("sudan", ["uuid"], {"year": ["2024"]})
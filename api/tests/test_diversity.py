@@ -0,0 +1,45 @@
+import numpy as np
+
+from diversity import diversify, select
+
+
+def test_relevance_only_keeps_the_ranking():
+    relevance = np.array([0.2, 0.9, 0.5, 0.7], dtype=np.float32)
+    vectors = np.eye(4, dtype=np.float32)
+    assert select(relevance, 3, vectors, mmr_lambda=1.0) == [1, 3, 2]
+
+
+def test_mmr_skips_near_duplicates():
+    # 0 and 1 are the same page; 2 is less relevant but different
+    vectors = np.array([[1, 0], [1, 0.01], [0, 1]], dtype=np.float32)
+    relevance = np.array([1.0, 0.95, 0.6], dtype=np.float32)
+    assert select(relevance, 2, vectors, mmr_lambda=1.0) == [0, 1]
+    assert select(relevance, 2, vectors, mmr_lambda=0.5) == [0, 2]
+
+
+def test_mmr_matches_brute_force():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(30, 8)).astype(np.float32)
+    relevance = rng.random(30).astype(np.float32)
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = []
+    while len(expected) < 10:
+        gains = [-np.inf if i in expected else
+                 0.7 * relevance[i] - 0.3 * max((unit[i] @ unit[j] for j in expected), default=0.0)
+                 for i in range(30)]
+        expected.append(int(np.argmax(gains)))
+    assert select(relevance, 10, vectors, mmr_lambda=0.7) == expected
+
+
+def test_per_group_cap():
+    relevance = np.array([0.9, 0.8, 0.7, 0.6, 0.5], dtype=np.float32)
+    groups = ["a", "a", "a", "b", "c"]
+    assert select(relevance, 4, groups=groups, max_per_group=2) == [0, 1, 3, 4]
+    assert select(relevance, 10, groups=groups, max_per_group=1) == [0, 3, 4]
+
+
+def test_diversify_results():
+    results = [{"uuid": f"u{i}", "id": f"r{i // 2}", "similarity": 0.1 * i, "embedding": [1.0, 0.1 * i]}
+               for i in range(6)]
+    assert [r["uuid"] for r in diversify(results, 3, max_per_report=1)] == ["u0", "u2", "u4"]
+    assert diversify([], 3, mmr_lambda=0.5) == []
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from filters import FILTER_COLUMNS, FilterIndex, normalize_value, resolve_filters
+
+RECORDS = [{"country_name": country, "year": year, "disaster": disaster, "theme_name": None, "source": "WFP"}
+           for country in ["Sudan", "Yemen", " south sudan"] for year in [2023, 2024]
+           for disaster in ["Cholera", "Flood", None]]
+
+
+def brute_force(records, filters):
+    return np.array([all(normalize_value("" if r[c] is None else r[c]) in values for c, values in filters.items())
+                     for r in records])
+
+
+@pytest.mark.parametrize("filters", [
+    {"country_name": "Sudan"},
+    {"country_name": ["sudan", "YEMEN"], "year": 2024},
+    {"year": ["2023"], "disaster": "cholera"},
+    {"country_name": "South Sudan", "source": "wfp"},
+    {"country_name": "Chad"},
+])
+def test_mask_matches_brute_force(filters, tmp_path):
+    index = FilterIndex.build(RECORDS)
+    resolved = resolve_filters(filters)
+    assert np.array_equal(index.mask(resolved), brute_force(RECORDS, resolved))
+    index.save(str(tmp_path / "filters.npz"))
+    loaded = FilterIndex.load(str(tmp_path / "filters.npz"))
+    assert np.array_equal(loaded.mask(resolved), brute_force(RECORDS, resolved))
+
+
+def test_postings_are_ascending_rows_of_one_value():
+    index = FilterIndex.build(RECORDS)
+    for column in FILTER_COLUMNS:
+        values, _, _ = index.columns[column]
+        for value in values:
+            rows = index.postings(column, value)
+            assert np.all(np.diff(rows) > 0)
+            assert rows.tolist() == [i for i, r in enumerate(RECORDS)
+                                     if normalize_value("" if r[column] is None else r[column]) == value]
+
+
+def test_no_filters():
+    assert resolve_filters(None) == {}
+    assert resolve_filters({"country_name": [], "year": None}) == {}
+    assert FilterIndex.build(RECORDS).mask({}) is None
+
+
+def test_invalid_filters():
+    with pytest.raises(ValueError):
+        resolve_filters({"uuid": "x"})
+    with pytest.raises(ValueError):
+        resolve_filters(["Sudan"])
@@ -0,0 +1,76 @@
+import math
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from lexical import TEXT_COLUMNS, BM25Index, tokenize, varint_decode, varint_encode, varint_sizes
+
+WORDS = ["sudan", "yemen", "cholera", "flood", "drought", "food", "insecurity", "wfp", "unhcr", "camp"]
+
+
+def records(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{"uuid": f"u{i:04d}", "title": " ".join(rng.choice(WORDS, 3)),
+             "combined_details": " ".join(rng.choice(WORDS, int(rng.integers(1, 30)))),
+             "document": None if i % 7 == 0 else "report", "country_name": ["Sudan", "Yemen"][i % 2],
+             "year": 2023 + i % 3}
+            for i in range(n)]
+
+
+def brute_force(records, text, k1=1.2, b=0.75):
+    docs = [Counter(tokenize(" ".join(str(r.get(c) or "") for c in TEXT_COLUMNS))) for r in records]
+    avg_length = np.mean([sum(d.values()) for d in docs])
+    scores = {}
+    for record, doc in zip(records, docs):
+        score = 0.0
+        for term in set(tokenize(text)):
+            if term in doc:
+                df = sum(term in other for other in docs)
+                idf = math.log1p((len(docs) - df + 0.5) / (df + 0.5))
+                tf = doc[term]
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * sum(doc.values()) / avg_length))
+        if score:
+            scores[record["uuid"]] = score
+    return scores
+
+
+@pytest.mark.parametrize("values", [[], [0], [1, 127, 128, 255, 16383, 16384], [2 ** 35, 0, 2 ** 63 - 1]])
+def test_varint_round_trip(values):
+    values = np.array(values, dtype=np.uint64)
+    encoded = varint_encode(values)
+    assert len(encoded) == varint_sizes(values).sum()
+    assert np.array_equal(varint_decode(encoded), values)
+
+
+def test_varint_sizes():
+    assert varint_sizes(np.array([0, 127, 128, 16383, 16384], dtype=np.uint64)).tolist() == [1, 1, 2, 2, 3]
+
+
+def test_bm25_matches_brute_force(tmp_path):
+    pages = records()
+    index = BM25Index.build(str(tmp_path), pages)
+    for text in ["cholera", "Sudan flood camp", "food insecurity wfp report"]:
+        expected = brute_force(pages, text)
+        uuids, scores = index.top_k(text, 10)
+        assert len(uuids) == min(10, len(expected))
+        assert np.allclose(scores, [expected[uuid] for uuid in uuids], rtol=1e-4)
+        # The k best, in order (ties may come in either order)
+        assert np.all(np.diff(scores) <= 0)
+        assert scores[-1] >= sorted(expected.values(), reverse=True)[len(uuids) - 1] - 1e-4
+
+
+def test_bm25_filters_keep_corpus_weights(tmp_path):
+    pages = records()
+    index = BM25Index.build(str(tmp_path), pages)
+    expected = brute_force(pages, "cholera")
+    uuids, scores = index.top_k("cholera", 1000, {"country_name": ["yemen"]})
+    assert {uuid for uuid in uuids} == {r["uuid"] for r in pages if r["country_name"] == "Yemen"} & expected.keys()
+    assert np.allclose(scores, [expected[uuid] for uuid in uuids], rtol=1e-4)
+
+
+def test_bm25_no_match(tmp_path):
+    index = BM25Index.build(str(tmp_path), records(20))
+    assert len(index.top_k("unknownterm", 5)[0]) == 0
+    assert len(index.top_k("cholera", 5, {"country_name": ["nowhere"]})[0]) == 0
+    assert len(index.top_k("cholera", 0)[0]) == 0
@@ -3,11 +3,16 @@
 # AI-powered Q&A bot using ReliefWeb reports to create a RAG model.
 # Rewritten to use google-generativeai SDK (no LangChain dependency)
 
+import itertools
+import json
 import os
 import streamlit as st
 import requests
 import google.generativeai as genai
 
+from answer_cache import AnswerCache, SemanticAnswerCache
+from context_builder import build_context_from_config
+
 # ----------------------------
 # Configure Streamlit page
 # ----------------------------
@@ -33,6 +38,8 @@ selected_model = st.sidebar.selectbox(
 )
 temperature = st.sidebar.slider("Model Temperature", 0.0, 1.0, 0.5, 0.05)
 k = st.sidebar.slider("Number of Similar Documents (k)", 1, 10, 5, 1)
+# Show the answer as Gemini writes it, instead of after the whole answer is generated
+stream_answer = st.sidebar.toggle("Stream Answer", value=True)
 
 # ----------------------------
 # User input
@@ -41,44 +48,169 @@ st.write("### Ask a question about nonprofit reports:")
 query = st.text_input("Your question", "")
 submit = st.button("Submit")
 
+# ----------------------------
+# Cached resources
+# ----------------------------
+# Streamlit reruns this script on every interaction; these are created once per
+# server process (and per argument values) and shared by every rerun and session.
+
+@st.cache_resource
+def load_secrets():
+    try:
+        return st.secrets["general"].get("SIMILARITY_API"), st.secrets["general"].get("GOOGLE_API_KEY")
+    except Exception:
+        return os.getenv("SIMILARITY_API"), os.getenv("GOOGLE_API_KEY")
+
+
+@st.cache_resource
+def similarity_session():
+    """One HTTP session for the similarity API, so its keep-alive connections are reused."""
+    session = requests.Session()
+    # Concurrent sessions of the app each hold a pooled connection
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_resource
+def configure_gemini(api_key):
+    genai.configure(api_key=api_key)
+
+
+@st.cache_resource
+def gemini_model(model_name, temperature, max_output_tokens):
+    """One Gemini model object per model name and generation config."""
+    return genai.GenerativeModel(
+        model_name,
+        generation_config=genai.types.GenerationConfig(
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+        ),
+    )
+
+
+@st.cache_resource
+def answer_cache():
+    """Answers reused for repeated questions (ANSWER_CACHE_SIZE / _TTL / _PATH, see answer_cache.py)."""
+    return AnswerCache.from_config()
+
+
+@st.cache_resource
+def semantic_cache():
+    """Answers and documents reused for paraphrased questions (SEMANTIC_CACHE_SIZE / _THRESHOLD)."""
+    return SemanticAnswerCache.from_config()
+
+
 # ----------------------------
 # Load API secrets
 # ----------------------------
-try:
-    SIMILARITY_API_URL = st.secrets["general"].get("SIMILARITY_API")
-    GOOGLE_API_KEY = st.secrets["general"].get("GOOGLE_API_KEY")
-except Exception:
-    SIMILARITY_API_URL = os.getenv("SIMILARITY_API")
-    GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+SIMILARITY_API_URL, GOOGLE_API_KEY = load_secrets()
 
 if not GOOGLE_API_KEY:
     st.error("❌ Google API key not found. Please set it in Streamlit secrets or as an environment variable.")
     st.stop()
 
 # Configure Gemini API
-genai.configure(api_key=GOOGLE_API_KEY)
+configure_gemini(GOOGLE_API_KEY)
+
+# The similarity API's query embedding endpoint, next to /similarity
+EMBED_API_URL = SIMILARITY_API_URL.rsplit("/similarity", 1)[0] + "/embed" if SIMILARITY_API_URL else None
+
+NO_RESPONSE = "⚠️ No response received from Gemini."
+
+
+def response_text(response):
+    """Text of a Gemini response or streamed chunk, or "" if it has none."""
+    try:
+        text = response.text
+    except (AttributeError, ValueError):
+        # .text raises when a candidate has no parts, e.g. the last chunk of a stream
+        text = None
+    if not text:
+        # Fallback if response.text is missing
+        parts = []
+        for c in getattr(response, "candidates", []) or []:
+            content = getattr(c, "content", None)
+            for p in getattr(content, "parts", []) or []:
+                txt = getattr(p, "text", "")
+                if txt:
+                    parts.append(txt)
+        text = "\n".join(parts)
+    return text
+
+
+def embed_query(text):
+    """Embedding of a question from the similarity API, or None if it is unavailable."""
+    try:
+        response = similarity_session().post(EMBED_API_URL, json={"text": text}, timeout=10)
+        response.raise_for_status()
+        return response.json()["embedding"]
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+        return None
+
+
+def prompt_tokens(response):
+    """Prompt tokens Gemini counted for a response, or None if it did not say."""
+    return getattr(getattr(response, "usage_metadata", None), "prompt_token_count", None) or None
+
+
+def stream_text(chunks, last):
+    for chunk in chunks:
+        # The usage metadata is complete on the last chunk
+        last["chunk"] = chunk
+        text = response_text(chunk)
+        if text:
+            yield text
+
 
 # ----------------------------
 # Main Logic
 # ----------------------------
 if submit and query.strip():
+    # A paraphrase of a recently answered question reuses its documents and answer
+    semantic = semantic_cache()
+    scope = SemanticAnswerCache.scope(selected_model, temperature, k)
+    query_embedding = embed_query(query) if semantic.cacheable(temperature) else None
+    semantic_hit = semantic.get(query, query_embedding, scope) if query_embedding is not None else None
+
     ##### Step 1: Call Similarity API #####
     st.subheader("📚 Retrieving Similar Documents")
-    with st.spinner("Finding relevant documents..."):
-        payload = {"text": query, "k": k}
-        try:
-            response = requests.post(SIMILARITY_API_URL, json=payload, timeout=30)
-            response.raise_for_status()
-            similar_docs = response.json().get("results", [])
-        except requests.exceptions.RequestException as e:
-            st.error(f"❌ Error calling Similarity API: {e}")
-            st.stop()
+    if semantic_hit is not None:
+        similar_docs = semantic_hit[1]
+        st.caption(f"⚡ Reusing the documents of a similar recent question (similarity {semantic_hit[2]:.2f})")
+    else:
+        with st.spinner("Finding relevant documents..."):
+            # Only the 500-character preview of each page is displayed, so don't transfer more.
+            # Results are streamed as NDJSON, one document per line, as the API fetches them.
+            payload = {"text": query, "k": k, "preview_chars": 500, "stream": True}
+            progress = st.empty()
+            similar_docs = []
+            try:
+                with similarity_session().post(SIMILARITY_API_URL, json=payload, timeout=30, stream=True) as response:
+                    response.raise_for_status()
+                    if response.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+                        for line in response.iter_lines():
+                            if not line:
+                                continue
+                            doc = json.loads(line)
+                            if "error" in doc:
+                                raise requests.exceptions.RequestException(doc["error"])
+                            similar_docs.append(doc)
+                            progress.caption(f"Retrieved {len(similar_docs)} of {k}: {doc.get('title', '')}")
+                    else:
+                        # An API (or proxy) that doesn't stream answers with a single JSON body
+                        similar_docs = response.json().get("results", [])
+                progress.empty()
+            # ValueError: a line or body that is not JSON
+            except (requests.exceptions.RequestException, ValueError) as e:
+                st.error(f"❌ Error calling Similarity API: {e}")
+                st.stop()
 
     ##### Step 2: Prepare context from documents #####
     if similar_docs:
-        context_details = "\n\n".join(
-            [doc.get("combined_details", "No details available") for doc in similar_docs]
-        )
+        # Ranked pages within a token budget (CONTEXT_MAX_TOKENS), trimmed and deduplicated
+        context_details, context_usage = build_context_from_config(similar_docs)
 
         ##### Step 3: Generate Final Answer Using Gemini #####
         st.subheader("🤖 Generating Final Answer")
@@ -94,58 +226,84 @@ if submit and query.strip():
             f"{system_prompt}\n\n### Context:\n{context_details}\n\n### User question:\n{query}"
         )
 
-        # Create the model
-        model = genai.GenerativeModel(selected_model)
+        # Reuse the model for this name and config; changing a sidebar setting selects another
+        model = gemini_model(selected_model, temperature, 1024)
 
-        with st.spinner("Creating final answer..."):
-            try:
-                response = model.generate_content(
-                    retrieval_prompt,
-                    generation_config=genai.types.GenerationConfig(
-                        temperature=temperature,
-                        max_output_tokens=1024,
-                    ),
-                )
+        # A repeated question that retrieved the same documents reuses the stored answer
+        cache = answer_cache()
+        uuids = [doc.get("uuid") for doc in similar_docs]
+        cache_key = None
+        if cache.cacheable(temperature) and None not in uuids:
+            cache_key = AnswerCache.key(query, system_prompt, selected_model, temperature, k, uuids)
+        if semantic_hit is not None:
+            cached_answer = semantic_hit[0]
+        else:
+            cached_answer = cache.get(cache_key) if cache_key else None
+
+        try:
+            if cached_answer is None:
+                with st.spinner("Creating final answer..."):
+                    if stream_answer:
+                        # The spinner only lasts until the first chunk arrives
+                        chunks = iter(model.generate_content(retrieval_prompt, stream=True))
+                        first = next(chunks, None)
+                    else:
+                        response = model.generate_content(retrieval_prompt)
+                        final_answer = response_text(response).strip() or NO_RESPONSE
 
-                # Extract final answer text
-                final_answer = getattr(response, "text", None)
+            # Display the agent response
+            st.subheader("🧠 Agent Response")
+            if cached_answer is not None:
+                final_answer = cached_answer
+                st.write(final_answer)
+                st.caption("⚡ Cached answer")
+            elif stream_answer:
+                # Each chunk is rendered as it arrives, with the same text fallback as a full response
+                chunks = itertools.chain([first] if first is not None else [], chunks)
+                last = {}
+                final_answer = st.write_stream(stream_text(chunks, last))
+                response = last.get("chunk")
                 if not final_answer:
-                    # Fallback if response.text is missing
-                    parts = []
-                    for c in getattr(response, "candidates", []) or []:
-                        content = getattr(c, "content", None)
-                        for p in getattr(content, "parts", []) or []:
-                            txt = getattr(p, "text", "")
-                            if txt:
-                                parts.append(txt)
-                    final_answer = "\n".join(parts).strip() or "⚠️ No response received from Gemini."
-
-                # Display the agent response
-                st.subheader("🧠 Agent Response")
+                    st.write(NO_RESPONSE)
+            else:
                 st.write(final_answer)
+            if cached_answer is None:
+                tokens = prompt_tokens(response)
+                st.caption(
+                    f"🧾 Context: {context_usage['documents']} of {len(similar_docs)} documents, "
+                    f"~{context_usage['context_tokens']} tokens, "
+                    f"{context_usage['trimmed_share']:.0%} of the retrieved text trimmed "
+                    f"({context_usage['duplicates']} duplicates, {context_usage['over_budget']} over budget)"
+                    + (f" · prompt: {tokens} tokens" if tokens else "")
+                )
+                if final_answer and final_answer != NO_RESPONSE:
+                    if cache_key:
+                        cache.put(cache_key, final_answer)
+                    if query_embedding is not None:
+                        semantic.put(query, query_embedding, scope, final_answer, similar_docs)
 
-                ##### Step 4: Display Retrieved Documents #####
-                st.subheader("📑 Retrieved Documents")
-                for i, doc in enumerate(similar_docs, start=1):
-                    st.markdown(f"### **Document {i}**")
-                    st.write(f"📌 **Title:** {doc.get('title', 'No title available')}")
-                    st.write(f"🔹 **Source:** {doc.get('source', 'Unknown source')}")
-                    st.write(f"🔹 **Page:** {doc.get('page_label', 'N/A')}")
-                    st.write(f"🌍 **URL:** [Click here]({doc.get('URL')})")
-                    preview = doc.get("document", "No details available")[:500]
-                    st.write(f"📝 **Content Preview:** {preview}...")
-
-            except Exception as e:
-                msg = str(e)
-                if "429" in msg or "quota" in msg.lower():
-                    st.error(
-                        "❌ Gemini returned a quota or rate-limiting error. "
-                        "Try using Flash/Lite, reduce k, or check your Google Cloud quota."
-                    )
-                    st.code(msg, language="text")  # 👈 Show actual error text
-                else:
-                    st.error("❌ Error generating response with Gemini:")
-                    st.code(msg, language="text")  # 👈 Display the real error message for visibility
+            ##### Step 4: Display Retrieved Documents #####
+            st.subheader("📑 Retrieved Documents")
+            for i, doc in enumerate(similar_docs, start=1):
+                st.markdown(f"### **Document {i}**")
+                st.write(f"📌 **Title:** {doc.get('title', 'No title available')}")
+                st.write(f"🔹 **Source:** {doc.get('source', 'Unknown source')}")
+                st.write(f"🔹 **Page:** {doc.get('page_label', 'N/A')}")
+                st.write(f"🌍 **URL:** [Click here]({doc.get('URL')})")
+                preview = doc.get("document", "No details available")[:500]
+                st.write(f"📝 **Content Preview:** {preview}...")
+
+        except Exception as e:
+            msg = str(e)
+            if "429" in msg or "quota" in msg.lower():
+                st.error(
+                    "❌ Gemini returned a quota or rate-limiting error. "
+                    "Try using Flash/Lite, reduce k, or check your Google Cloud quota."
+                )
+                st.code(msg, language="text")  # 👈 Show actual error text
+            else:
+                st.error("❌ Error generating response with Gemini:")
+                st.code(msg, language="text")  # 👈 Display the real error message for visibility
 
 
     else:
@@ -0,0 +1,92 @@
+# Prompt context for the Streamlit app (app.py): the retrieved pages'
+# combined_details, in relevance order, within a token budget. Repeated
+# passages are dropped and long pages are cut at sentence boundaries, so the
+# prompt (and Gemini's latency, cost and quota use) stops growing with k.
+#
+# Tokens are estimated at CHARS_PER_TOKEN characters each, which is close for
+# Gemini on English text and costs no API call; the exact prompt size is
+# reported by Gemini after generation.
+#
+# Configured through environment variables:
+#   CONTEXT_MAX_TOKENS           budget of the whole context
+#   CONTEXT_MAX_TOKENS_PER_DOC   most tokens taken from one page
+
+import math
+import os
+import re
+
+CHARS_PER_TOKEN = 4
+# A page that would get fewer tokens than this is left out rather than cut to a stub
+MIN_DOC_TOKENS = 32
+
+# Marks a page that was cut short
+ELLIPSIS = " …"
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def fold(text):
+    return " ".join(text.split()).casefold()
+
+
+def trim_to_tokens(text, max_tokens):
+    """The leading whole sentences of `text` that fit in max_tokens; a first sentence too long is cut at a word."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    max_chars -= len(ELLIPSIS)
+    kept = ""
+    for sentence in SENTENCE_END.split(text):
+        candidate = f"{kept} {sentence}" if kept else sentence
+        if len(candidate) > max_chars:
+            break
+        kept = candidate
+    if not kept:
+        kept = text[:max_chars].rsplit(" ", 1)[0]
+    return kept + ELLIPSIS
+
+
+def build_context(docs, max_tokens=3000, max_tokens_per_doc=600, column="combined_details"):
+    """(context, usage) of ranked `docs`: their `column` text joined by blank lines, within max_tokens.
+
+    `usage` counts the pages used, trimmed, dropped as duplicates and left out
+    for lack of budget, and the estimated tokens of the input and of the context.
+    """
+    passages, seen = [], []
+    usage = {"documents": 0, "trimmed": 0, "duplicates": 0, "over_budget": 0, "input_tokens": 0, "context_tokens": 0}
+    remaining = max_tokens
+    for doc in docs:
+        text = (doc.get(column) or "").strip()
+        usage["input_tokens"] += estimate_tokens(text)
+        folded = fold(text)
+        if not folded:
+            continue
+        # The same passage, or one contained in a passage already used, adds nothing
+        if any(folded in other for other in seen):
+            usage["duplicates"] += 1
+            continue
+        allowed = min(max_tokens_per_doc, remaining)
+        if allowed < MIN_DOC_TOKENS:
+            usage["over_budget"] += 1
+            continue
+        passage = trim_to_tokens(text, allowed)
+        if passage != text:
+            usage["trimmed"] += 1
+        tokens = estimate_tokens(passage)
+        passages.append(passage)
+        seen.append(folded)
+        remaining -= tokens
+        usage["documents"] += 1
+        usage["context_tokens"] += tokens
+    usage["trimmed_share"] = round(1 - usage["context_tokens"] / usage["input_tokens"], 4) \
+        if usage["input_tokens"] else 0.0
+    return "\n\n".join(passages), usage
+
+
+def build_context_from_config(docs):
+    return build_context(docs, int(os.getenv("CONTEXT_MAX_TOKENS", 3000)),
+                         int(os.getenv("CONTEXT_MAX_TOKENS_PER_DOC", 600)))